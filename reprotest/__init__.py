@@ -3,7 +3,11 @@
 
 import argparse
 import collections
+import concurrent.futures
 import configparser
+import functools
+import hashlib
+import json
 import logging
 import os
 import pathlib
@@ -11,9 +15,11 @@ import random
 import re
 import shlex
 import shutil
+import stat
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import traceback
 import types
@@ -22,8 +28,12 @@ import pkg_resources
 
 from reprotest.lib import adtlog
 from reprotest.lib import adt_testbed
+from reprotest import _cache
+from reprotest import _compare
 from reprotest import _contextlib
 from reprotest import _shell_ast
+from reprotest import _treehash
+from reprotest import daemon
 from reprotest import presets
 
 
@@ -49,20 +59,58 @@ def get_all_servers():
 # variety of other options including Docker etc that use different
 # approaches.
 
-@_contextlib.contextmanager
-def start_testbed(args, temp_dir, no_clean_on_error=False):
-    '''This is a simple wrapper around adt_testbed that automates the
-    initialization and cleanup.'''
+def start_server(args, output_dir, agent=False):
+    '''Starts a virtual server, without opening a testbed in it yet.'''
     # Find the location of reprotest using setuptools and then get the
     # path for the correct virt-server script.
     server_path = get_server_path(args[0])
     logging.info('STARTING VIRTUAL SERVER %r', [server_path] + args[1:])
-    testbed = adt_testbed.Testbed([server_path] + args[1:], temp_dir, None)
+    # these run commands on the host, so they don't need a process of their
+    # own; chroot needs root to do that without a --gain-root command
+    in_process = args[0] == 'null' or (args[0] == 'chroot' and os.geteuid() == 0)
+    testbed = adt_testbed.Testbed([server_path] + args[1:], output_dir, None,
+                                  use_agent=agent, in_process=in_process)
     testbed.start()
+    return testbed
+
+def open_testbed(args, output_dir, agent=False):
+    '''Starts a virtual server and opens a testbed in it.
+
+    If agent is True, short commands are run through an agent in the testbed
+    instead of starting a new auxverb process for each of them.'''
+    testbed = start_server(args, output_dir, agent)
     testbed.open()
+    return testbed
+
+@_contextlib.contextmanager
+def start_testbeds(args, temp_dir, no_clean_on_error=False, separate=False,
+                   agent=False):
+    '''This is a simple wrapper around adt_testbed that automates the
+    initialization and cleanup.
+
+    Yields a Pair of testbeds.  If separate is True, the control and the
+    experiment each get their own testbed, and both are started at the same
+    time so that their boot times overlap.  Otherwise, both builds share a
+    single testbed.'''
+    if separate:
+        def start(name):
+            output_dir = os.path.join(temp_dir, name + '-testbed')
+            os.mkdir(output_dir)
+            return open_testbed(args, output_dir, agent)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(start, name) for name in Pair._fields]
+        started = [f.result() for f in futures if not f.exception()]
+        if len(started) < 2:
+            for testbed in started:
+                testbed.stop()
+            for f in futures:
+                f.result()
+        testbeds = Pair(*started)
+    else:
+        testbeds = Pair.of(open_testbed(args, temp_dir, agent))
     should_clean = True
     try:
-        yield testbed
+        yield testbeds
     except:
         if no_clean_on_error:
             should_clean = False
@@ -71,7 +119,20 @@ def start_testbed(args, temp_dir, no_clean_on_error=False):
         if should_clean:
             # TODO: we could probably do *some* level of cleanup even if
             # should_clean is False; investigate this further...
-            testbed.stop()
+            for testbed in testbeds.unique():
+                testbed.stop()
+
+@_contextlib.contextmanager
+def use_testbed(testbed):
+    '''Like start_testbeds(), but for a testbed that was already opened by
+    the caller, e.g. the daemon's pool. It is left running afterwards.'''
+    yield Pair.of(testbed)
+
+@_contextlib.contextmanager
+def start_testbed(args, temp_dir, no_clean_on_error=False):
+    '''Like start_testbeds(), but for a single testbed.'''
+    with start_testbeds(args, temp_dir, no_clean_on_error) as testbeds:
+        yield testbeds.control
 
 
 class Pair(collections.namedtuple('_Pair', 'control experiment')):
@@ -80,6 +141,10 @@ class Pair(collections.namedtuple('_Pair', 'control experiment')):
     def of(cls, x):
         return cls(x, x)
 
+    def unique(self):
+        '''Returns the distinct objects, i.e. just one for Pair.of(x).'''
+        return self[:1] if self.control is self.experiment else tuple(self)
+
 def add(mapping, key, value):
     '''Helper function for adding a key-value pair to an immutable mapping.'''
     new_mapping = mapping.copy()
@@ -309,14 +374,13 @@ def timezone(script, env, tree, *args):
     experiment = add(env.experiment, 'TZ', 'GMT-14')
     return script, Pair(control, experiment), tree
 
-def faketime(script, env, tree, source_root):
+def faketime(script, env, tree, source_root, source_scan):
     # Get the latest modification date of all the files in the source root.
     # This tries hard to avoid bad interactions with faketime and make(1) etc.
     # However if you're building this too soon after changing one of the source
     # files then the effect of this variation is not very great.
-    filemtimes = (os.path.getmtime(os.path.join(root, f)) for root, dirs, files in os.walk(source_root) for f in files)
     now = time.time()
-    lastmt = int(max(filemtimes, default=now))
+    lastmt = int(source_scan.latest_mtime(default=now))
     if lastmt < now - 32253180:
         # if lastmt is far in the past, use that, it's a bit safer
         faket = '@%s' % lastmt
@@ -362,7 +426,18 @@ VARIATIONS = types.MappingProxyType(collections.OrderedDict([
 ]))
 
 
-def build(script, env, source_root_orig, source_root_build, dist_root, artifact_pattern, testbed):
+def output_fd(stream, fd):
+    '''Returns the file descriptor that subprocesses should write the
+    output meant for stream to, or None if that is fd, which they inherit
+    anyway. They differ e.g. for the jobs of a daemon.ThreadOutput.'''
+    try:
+        stream_fd = stream.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+    return None if stream_fd == fd else stream_fd
+
+
+def build(script, env, source_root_orig, source_root_build, dist_root, artifact_pattern, testbed, log=None):
     logging.info("starting build with source directory: %s, artifact pattern: %s",
         source_root_orig, artifact_pattern)
     # remove any existing artifact, in case the build script doesn't overwrite
@@ -376,7 +451,15 @@ def build(script, env, source_root_orig, source_root_build, dist_root, artifact_
     logging.info("executing: %s", new_script)
     argv = ['sh', '-ec', str(new_script)]
     xenv = ['%s=%s' % (k, v) for k, v in env.items()]
-    (code, _, _) = testbed.execute(argv, xenv=xenv, kind='build')
+    # if a log file is given, the build's stdout and stderr both go there
+    if log is None:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        stdout, stderr = output_fd(sys.stdout, 1), output_fd(sys.stderr, 2)
+    else:
+        stdout, stderr = log, subprocess.STDOUT
+    (code, _, _) = testbed.execute(argv, xenv=xenv, kind='build',
+                                   stdout=stdout, stderr=stderr)
     if code != 0:
         testbed.bomb('"%s" failed with status %i' % (' '.join(argv), code), adtlog.AutopkgtestError)
     dist_base = os.path.join(dist_root, VSRC_DIR)
@@ -387,23 +470,139 @@ cd "{0}" && touch -d@0 . .. {2}
 """.format(dist_base, source_root_orig, artifact_pattern)])
 
 
+def build_concurrently(testbeds, steps, logs):
+    '''Runs the control and experiment build steps at the same time.
+
+    Args:
+        testbeds (Pair): The testbeds the builds run in.
+        steps (Pair): For each build, a list of functions that are called in
+            order with the file the step should write its output to.
+        logs (Pair): The file names to write each build's output to.  These
+            are replayed on stdout once both builds are done, so that the
+            output of the two builds doesn't get interleaved.
+
+    As soon as one build fails, the other one is cancelled: its running
+    testbed commands, and any it starts before noticing, are killed and its
+    remaining steps are skipped.  The exception of the first failure is then
+    re-raised.
+    '''
+    cancelled = threading.Event()
+    failures = []
+    failures_lock = threading.Lock()
+
+    def run(side_steps, log_path):
+        with open(log_path, 'wb') as log:
+            for step in side_steps:
+                if cancelled.is_set():
+                    return
+                try:
+                    step(log)
+                except Exception as e:
+                    with failures_lock:
+                        failures.append(e)
+                        first = not cancelled.is_set()
+                        cancelled.set()
+                    if first:
+                        for testbed in testbeds.unique():
+                            testbed.cancel()
+                    return
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            for f in [executor.submit(run, *a) for a in zip(steps, logs)]:
+                f.result()
+    finally:
+        for testbed in testbeds.unique():
+            testbed.uncancel()
+
+    sys.stdout.flush()
+    for name, log_path in zip(Pair._fields, logs):
+        logging.info("output of the %s build:", name)
+        sys.stdout.flush()
+        with open(log_path, 'rb') as log:
+            shutil.copyfileobj(log, sys.stdout.buffer)
+        sys.stdout.buffer.flush()
+
+    if failures:
+        raise failures[0]
+
+
 def run_or_tee(progargs, filename, store_dir, *args, **kwargs):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    stdout, stderr = output_fd(sys.stdout, 1), output_fd(sys.stderr, 2)
     if store_dir:
-        tee = subprocess.Popen(['tee', filename], stdin=subprocess.PIPE, cwd=store_dir)
-        r = subprocess.run(progargs, *args, stdout=tee.stdin, **kwargs)
+        tee = subprocess.Popen(['tee', filename], stdin=subprocess.PIPE, cwd=store_dir,
+                               stdout=stdout)
+        r = subprocess.run(progargs, *args, stdout=tee.stdin, stderr=stderr, **kwargs)
         tee.communicate()
         return r
     else:
-        return subprocess.run(progargs, *args, **kwargs)
-
+        return subprocess.run(progargs, *args, stdout=stdout, stderr=stderr, **kwargs)
+
+
+def find_files(paths, cwd):
+    '''Yields the regular files under paths (relative to cwd), in the same
+    order and with the same names as find(1) without -L would.'''
+    for path in paths:
+        fspath = os.path.join(cwd, path)
+        try:
+            st = os.lstat(fspath)
+        except FileNotFoundError:
+            logging.warning("find: %s: No such file or directory", os.fsdecode(path))
+            continue
+        if stat.S_ISREG(st.st_mode):
+            yield path, fspath
+        elif stat.S_ISDIR(st.st_mode):
+            prefix = path if path.endswith(b'/') else path + b'/'
+            for entry in os.scandir(fspath):
+                if entry.is_dir(follow_symlinks=False):
+                    yield from find_files([prefix + entry.name], cwd)
+                elif entry.is_file(follow_symlinks=False):
+                    yield prefix + entry.name, entry.path
+
+def sha256sums(artifact_pattern, cwd):
+    '''Returns what "find <artifact_pattern> -type f -exec sha256sum {} ;"
+    would output in cwd, without running a process for each file.'''
+    cwd = os.fsencode(cwd)
+    # let the shell expand the pattern, exactly as it would for find
+    paths = subprocess.check_output(
+        ['sh', '-ec', 'printf "%%s\\0" %s' % artifact_pattern], cwd=cwd).split(b'\0')[:-1]
+    files = list(find_files(paths, cwd))
+    lines = []
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        digests = executor.map(_treehash.hash_file, [fspath for _, fspath in files])
+        for (name, _), digest in zip(files, digests):
+            # the same escaping as sha256sum
+            escaped = name.replace(b'\\', b'\\\\').replace(b'\n', b'\\n').replace(b'\r', b'\\r')
+            lines.append(b'%s%s  %s\n' % (b'\\' if escaped != name else b'',
+                                          digest.encode('ascii'), escaped))
+    return b''.join(lines)
 
 def check(build_command, artifact_pattern, virtual_server_args, source_root,
           no_clean_on_error=False, variations=VARIATIONS,
           store_dir=None, diffoscope_args=[],
-          testbed_pre=None, testbed_init=None):
+          testbed_pre=None, testbed_init=None, concurrent_builds=False,
+          separate_testbeds=False, testbed=None, control_cache=None,
+          sync_dir=None, testbed_agent=False):
     # default argument [] is safe here because we never mutate it.
     if not source_root:
         raise ValueError("invalid source root: %s" % source_root)
+    if concurrent_builds and 'build_path' not in variations:
+        # both builds then happen in the same const_build_path directory
+        logging.warning("Not varying build_path, so the builds can't run "
+                        "concurrently; running them one after the other.")
+        concurrent_builds = False
+    if separate_testbeds and 'build_path' not in variations:
+        # const_build_path must be in the same place for both builds
+        logging.warning("Not varying build_path, so the builds can't use "
+                        "separate testbeds; sharing one testbed instead.")
+        separate_testbeds = False
+    if control_cache and 'build_path' not in variations:
+        # the control would be built in a different directory each time
+        logging.warning("Not varying build_path, so the control build can't "
+                        "be cached; not using the control cache.")
+        control_cache = None
     if store_dir:
         store_dir = str(store_dir)
         if not os.path.exists(store_dir):
@@ -419,23 +618,42 @@ def check(build_command, artifact_pattern, virtual_server_args, source_root,
                types.MappingProxyType(os.environ.copy()))
 
     source_root = str(source_root)
+    if sync_dir:
+        # one mirror per source tree and build, so that separate testbeds on
+        # the same machine don't sync into the same directory
+        name = hashlib.sha256(os.path.abspath(source_root).encode(
+            'utf-8', 'surrogateescape')).hexdigest()[:16]
+        mirror = Pair(os.path.join(str(sync_dir), name + '-control/'),
+                      os.path.join(str(sync_dir), name + '-experiment/'))
+    # the faketime variation and the control cache both need to look at the
+    # whole source tree; make sure this only happens once.
+    orig_source_scan = source_scan = _treehash.TreeScan(source_root)
     with tempfile.TemporaryDirectory() as temp_dir:
         if testbed_pre:
             new_source_root = os.path.join(temp_dir, "testbed_pre")
             shutil.copytree(source_root, new_source_root, symlinks=True)
-            subprocess.check_call(["sh", "-ec", testbed_pre], cwd=new_source_root)
+            subprocess.check_call(["sh", "-ec", testbed_pre], cwd=new_source_root,
+                                  stdout=output_fd(sys.stdout, 1),
+                                  stderr=output_fd(sys.stderr, 2))
             source_root = new_source_root
+            source_scan = _treehash.TreeScan(source_root)
         logging.debug("source_root: %s", source_root)
 
         result = Pair(os.path.join(temp_dir, 'control_artifact/'),
                       os.path.join(temp_dir, 'experiment_artifact/'))
 
-        # TODO: an alternative strategy is to run the testbed twice; not sure
-        # if it's worth implementing at this stage, but perhaps in the future.
-        with start_testbed(virtual_server_args, temp_dir, no_clean_on_error) as testbed:
+        if testbed is not None:
+            testbeds_context = use_testbed(testbed)
+        else:
+            testbeds_context = start_testbeds(
+                virtual_server_args, temp_dir, no_clean_on_error, separate_testbeds,
+                testbed_agent)
+        with testbeds_context as testbeds:
             # directories need explicit '/' appended for VirtSubproc
-            tree = Pair(testbed.scratch + '/control/', testbed.scratch + '/experiment/')
-            dist = Pair(testbed.scratch + '/control-dist/', testbed.scratch + '/experiment-dist/')
+            tree = Pair(testbeds.control.scratch + '/control/',
+                        testbeds.experiment.scratch + '/experiment/')
+            dist = Pair(testbeds.control.scratch + '/control-dist/',
+                        testbeds.experiment.scratch + '/experiment-dist/')
             source_root = source_root + '/'
 
             orig_tree = tree
@@ -445,50 +663,140 @@ def check(build_command, artifact_pattern, virtual_server_args, source_root,
                 vary = VARIATIONS[variation]
                 negative = hasattr(vary, "negative") and vary.negative
                 if (variation in variations) != negative:
-                    script, env, tree = vary(script, env, tree, source_root)
+                    script, env, tree = vary(script, env, tree, source_root, source_scan)
                     logging.info("will %s: %s", "FIX" if negative else "vary", variation)
                     logging.log(5, "builds: %r", (script, env, tree))
 
+            cache_key = None
+            builds = (0, 1)
+            if control_cache:
+                scratch = testbeds.control.scratch
+                # hash the original tree rather than the output of
+                # testbed_pre, which is a fresh copy each time
+                cache_key = control_cache.key(
+                    control_cache.tree_digest(orig_source_scan), testbed_pre,
+                    str(script.control).replace(scratch, '$SCRATCH'),
+                    {k: v.replace(scratch, '$SCRATCH') for k, v in env.control.items()
+                     if k not in _cache.VOLATILE_ENV},
+                    artifact_pattern, virtual_server_args, testbed_init,
+                    testbeds.control.dpkg_arch,
+                    testbeds.control.initial_kernel_version)
+                if control_cache.lookup(cache_key, result.control):
+                    cache_key = None
+                    builds = (1,)
+
             try:
                 # run the scripts
                 if testbed_init:
-                    testbed.check_exec(["sh", "-ec", testbed_init])
-
-                for i in (0, 1):
+                    with concurrent.futures.ThreadPoolExecutor() as executor:
+                        for f in [executor.submit(t.check_exec, ["sh", "-ec", testbed_init])
+                                  for t in testbeds.unique()]:
+                            f.result()
+
+                def copydown(i, log=None):
+                    if sync_dir:
+                        # only send what changed since the last run
+                        logging.info("syncing %s to virtual server's %s", source_root, mirror[i])
+                        sent, removed = testbeds[i].command('syncdown', (source_root, mirror[i]), 2)
+                        logging.info("sent %s and removed %s entries", sent, removed)
+                        clone(i, mirror[i])
+                        return
                     logging.info("copying %s over to virtual server's %s", source_root, orig_tree[i])
-                    testbed.command('copydown', (source_root, orig_tree[i]))
-
-                for i in (0, 1):
+                    testbeds[i].command('copydown', (source_root, orig_tree[i]))
+
+                def clone(i, source, log=None):
+                    # a copy inside the testbed is much cheaper than a second
+                    # copydown, especially over ssh or qemu
+                    logging.info("copying virtual server's %s to %s", source, orig_tree[i])
+                    testbeds[i].check_exec(
+                        ['cp', '-a', '--reflink=auto',
+                         source.rstrip('/'), orig_tree[i].rstrip('/')],
+                        kind='copy')
+
+                def run_build(i, log=None):
                     build(script[i], env[i], orig_tree[i], tree[i], dist[i],
-                          artifact_pattern, testbed)
+                          artifact_pattern, testbeds[i], log)
 
-                for i in (0, 1):
+                def copyup(i, log=None):
                     logging.info("copying %s back from virtual server's %s", dist[i], result[i])
-                    testbed.command('copyup', (dist[i], result[i]))
+                    testbeds[i].command('copyup', (dist[i], result[i]))
+
+                if len(builds) == 2 and len(testbeds.unique()) == 1:
+                    # copy the source over only once
+                    copydown(0)
+                    clone(1, orig_tree[0])
+                    build_steps = (run_build, copyup)
+                else:
+                    build_steps = (copydown, run_build, copyup)
+
+                if concurrent_builds:
+                    steps = Pair(*([functools.partial(step, i)
+                                    for step in build_steps]
+                                   if i in builds else []
+                                   for i in (0, 1)))
+                    logs = Pair(os.path.join(temp_dir, 'control.log'),
+                                os.path.join(temp_dir, 'experiment.log'))
+                    build_concurrently(testbeds, steps, logs)
+                else:
+                    for step in build_steps:
+                        if step is copyup and len(testbeds.unique()) == 1:
+                            # send both copyups at once, rather than
+                            # waiting for the first before sending the second
+                            for i in builds:
+                                logging.info("copying %s back from virtual server's %s", dist[i], result[i])
+                            testbeds.control.command_batch(
+                                [('copyup', (dist[i], result[i]), 0) for i in builds])
+                            continue
+                        for i in builds:
+                            step(i)
             except Exception:
                 traceback.print_exc()
                 return 2
 
+            if cache_key:
+                control_cache.store(cache_key, result.control)
+
         if store_dir:
             shutil.copytree(result.control, store.control, symlinks=True)
             shutil.copytree(result.experiment, store.experiment, symlinks=True)
 
-        if diffoscope_args is None: # don't run diffoscope
-            diffprogram = ['diff', '-ru', result.control, result.experiment]
-            logging.info("Running diff: %r", diffprogram)
+        # only give diff or diffoscope what they need to look at; if the
+        # trees differ in more than file contents, that is all of it.
+        differences = _compare.differing_files(result.control, result.experiment)
+        if differences is None:
+            diff_tree = result
         else:
-            diffprogram = ['diffoscope', result.control, result.experiment] + diffoscope_args
-            logging.info("Running diffoscope: %r", diffprogram)
-
-        retcode = run_or_tee(diffprogram, 'diffoscope.out', store_dir).returncode
+            diff_tree = Pair(os.path.join(temp_dir, 'control_differences/'),
+                             os.path.join(temp_dir, 'experiment_differences/'))
+            for i in (0, 1):
+                _compare.link_files(result[i], diff_tree[i], differences)
+
+        if differences == []:
+            logging.info("Artifacts are identical, not running %s",
+                         "diff" if diffoscope_args is None else "diffoscope")
+            if store_dir:
+                open(os.path.join(store_dir, 'diffoscope.out'), 'w').close()
+            retcode = 0
+        else:
+            if diffoscope_args is None: # don't run diffoscope
+                diffprogram = ['diff', '-ru', diff_tree.control, diff_tree.experiment]
+                logging.info("Running diff: %r", diffprogram)
+            else:
+                diffprogram = ['diffoscope', diff_tree.control, diff_tree.experiment] + diffoscope_args
+                logging.info("Running diffoscope: %r", diffprogram)
+
+            retcode = run_or_tee(diffprogram, 'diffoscope.out', store_dir).returncode
         if retcode == 0:
             print("=======================")
             print("Reproduction successful")
             print("=======================")
             print("No differences in %s" % artifact_pattern, flush=True)
-            run_or_tee(['sh', '-ec', 'find %s -type f -exec sha256sum "{}" \;' % artifact_pattern],
-                'SHA256SUMS', store_dir,
-                cwd=os.path.join(result.control, VSRC_DIR))
+            sums = sha256sums(artifact_pattern, os.path.join(result.control, VSRC_DIR))
+            sys.stdout.buffer.write(sums)
+            sys.stdout.buffer.flush()
+            if store_dir:
+                with open(os.path.join(store_dir, 'SHA256SUMS'), 'wb') as f:
+                    f.write(sums)
 
             if store_dir:
                 shutil.rmtree(store.experiment)
@@ -499,13 +807,120 @@ def check(build_command, artifact_pattern, virtual_server_args, source_root,
         return retcode
 
 
+def resolve_auto_preset(source, virtual_server_args, auto_preset_expr="_"):
+    '''Guesses how to build source, for the "auto" build command.
+
+    Returns:
+        A (source_root, preset) tuple, where preset is a
+        presets.ReprotestPreset transformed by auto_preset_expr.'''
+    source_root = os.path.normpath(os.path.dirname(source)) if os.path.isfile(source) else source
+    values = presets.get_presets(source, virtual_server_args[0])
+    values = eval(auto_preset_expr, {'_':values}, {})
+    logging.info("preset auto-selected: %r", values)
+    return source_root, values
+
+
+def check_one_of_batch(source, virtual_server_args, store_dir, log,
+                       auto_preset_expr="_", **kwargs):
+    '''Worker for check_batch(); runs in its own process.
+
+    All output, including that of subprocesses, goes into the file log.
+
+    Returns:
+        A dict with the result record for source.'''
+    record = collections.OrderedDict(source=source)
+    start = time.time()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = os.dup(1), os.dup(2)
+    with open(log, 'w', buffering=1) as logfile, \
+         _contextlib.redirect_stdout(logfile), \
+         _contextlib.redirect_stderr(logfile):
+        # subprocesses write to the file descriptors directly
+        os.dup2(logfile.fileno(), 1)
+        os.dup2(logfile.fileno(), 2)
+        try:
+            source_root, values = resolve_auto_preset(
+                source, virtual_server_args, auto_preset_expr)
+            record.update(build_command=values.build_command, artifact=values.artifact)
+            retcode = check(values.build_command, values.artifact,
+                            virtual_server_args, source_root, store_dir=store_dir,
+                            testbed_pre=values.testbed_pre,
+                            testbed_init=values.testbed_init, **kwargs)
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                retcode = e.code or 0
+            else:
+                # a message, which exiting would have printed
+                print(e.code, file=sys.stderr)
+                retcode = 2
+        except Exception:
+            traceback.print_exc()
+            retcode = 2
+        finally:
+            # e.g. logging handlers, still holding the original streams
+            sys.__stdout__.flush()
+            sys.__stderr__.flush()
+            for fd, saved in zip((1, 2), saved_fds):
+                os.dup2(saved, fd)
+                os.close(saved)
+    record.update(
+        status={0: 'reproducible', 1: 'unreproducible'}.get(retcode, 'error'),
+        retcode=retcode, duration=round(time.time() - start, 3))
+    return record
+
+
+def check_batch(sources, virtual_server_args, store_dir, jobs=None,
+                auto_preset_expr="_", **kwargs):
+    '''Checks many sources, guessing how to build each as for "auto".
+
+    Up to jobs sources (default: the number of CPUs) are checked at the same
+    time, each in its own process with its own testbed. For each source,
+    store_dir gets a subdirectory with its artifacts and a .log file with
+    its output. One JSON result record per source is printed when it is
+    done, and also appended to store_dir/results.jsonl.
+
+    Returns:
+        The worst return code of any source, as for check().'''
+    store_dir = str(store_dir)
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir, exist_ok=False)
+    elif os.listdir(store_dir):
+        raise ValueError("store_dir must be empty: %s" % store_dir)
+
+    names = []
+    for source in sources:
+        name = os.path.basename(os.path.normpath(source))
+        if name in names:
+            name = "%s.%s" % (name, len(names))
+        names.append(name)
+
+    logging.info("checking %s sources, %s at a time", len(sources), jobs or os.cpu_count())
+    worst = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor, \
+         open(os.path.join(store_dir, 'results.jsonl'), 'w') as results:
+        futures = [executor.submit(
+            check_one_of_batch, os.path.abspath(source), virtual_server_args,
+            os.path.join(store_dir, name), os.path.join(store_dir, name + '.log'),
+            auto_preset_expr, **kwargs) for source, name in zip(sources, names)]
+        for f in concurrent.futures.as_completed(futures):
+            line = json.dumps(f.result())
+            print(line, flush=True)
+            print(line, file=results, flush=True)
+            worst = max(worst, f.result()['retcode'])
+    return worst
+
+
 COMMAND_LINE_OPTIONS = types.MappingProxyType(collections.OrderedDict([
     ('build_command', types.MappingProxyType({
         'default': None, 'nargs': '?', # 'type': str.split
         'help': 'Build command to execute, or "auto" to guess this. In '
                 'the latter case, the next argument \'artifact\' will not be '
                 'interpreted that way but instead as the source to build, '
-                'e.g. "." or some other path.'})),
+                'e.g. "." or some other path. Or "batch" to check many '
+                'sources, in which case \'artifact\' is instead a file listing '
+                'the sources to build (as for "auto"), one per line. This '
+                'needs --store-dir.'})),
     ('artifact', types.MappingProxyType({
         'default': None, 'nargs': '?',
         'help': 'Build artifact to test for reproducibility. May be a shell '
@@ -556,6 +971,11 @@ COMMAND_LINE_OPTIONS = types.MappingProxyType(collections.OrderedDict([
         'that transforms the _ variable, which is of type reprotest.presets.ReprotestPreset. '
         'See that class\'s documentation for ways you can write this '
         'expression. Default: %(default)s'})),
+    ('--jobs', types.MappingProxyType({
+        'type': int, 'default': None, 'metavar': 'N',
+        'help': 'With the "batch" build command, how many sources to check at '
+                'the same time, each in its own testbed. With --daemon, how '
+                'many testbeds to keep ready. Default: the number of CPUs.'})),
     ('--variations', types.MappingProxyType({
         'type': lambda s: frozenset(s.split(',')),
         'default': frozenset(VARIATIONS.keys()),
@@ -579,6 +999,70 @@ COMMAND_LINE_OPTIONS = types.MappingProxyType(collections.OrderedDict([
         'don\'t want to install diffoscope and/or just want a quick answer '
         'on whether the reproduction was successful or not, without spending '
         'time to compute all the detailed differences.'})),
+    ('--concurrent-builds', types.MappingProxyType({
+        'action': 'store_true', 'default': False,
+        'help': 'Run the control and experiment builds at the same time, '
+                'instead of one after the other. Their output is shown '
+                'separately once both are done. If one build fails, the '
+                'other one is cancelled. This has no effect when not varying '
+                'build_path, since both builds then use the same directory.'})),
+    ('--separate-testbeds', types.MappingProxyType({
+        'action': 'store_true', 'default': False,
+        'help': 'Start a separate testbed for each of the control and '
+                'experiment builds, at the same time, so that each build '
+                'runs in its own testbed and their boot times overlap. Use '
+                'together with --concurrent-builds to also overlap the '
+                'builds. This has no effect when not varying build_path.'})),
+    ('--control-cache', types.MappingProxyType({
+        'dest': 'control_cache', 'default': None, 'metavar': 'DIR',
+        'help': 'Cache the artifacts of control builds in DIR, and reuse '
+                'them instead of building the control again when the source '
+                'tree, build command, control environment (apart from '
+                'per-shell variables such as SHLVL or SSH_AUTH_SOCK) and '
+                'testbed are the same. Only the experiment is then built. Note that the '
+                'contents of the testbed are not part of this; don\'t use '
+                'the cache across upgrades of e.g. your schroot. This has no '
+                'effect when not varying build_path.'})),
+    ('--control-cache-size', types.MappingProxyType({
+        'dest': 'control_cache_size', 'type': int, 'default': None, 'metavar': 'MIB',
+        'help': 'Evict the least recently used control builds once the '
+                '--control-cache grows over this size. Default: 1024'})),
+    ('--no-control-cache', types.MappingProxyType({
+        'action': 'store_true', 'default': False,
+        'help': 'Don\'t use the --control-cache, e.g. if it is set in the '
+                'config file.'})),
+    ('--sync-dir', types.MappingProxyType({
+        'default': None, 'metavar': 'TB_DIR',
+        'help': 'Keep a mirror of the source tree in TB_DIR inside the '
+                'testbed, and only send the files that changed since the '
+                'last run, instead of copying the whole source each time. '
+                'Only useful with testbeds that persist between runs, e.g. '
+                'ssh or null. Don\'t run several reprotest processes on the '
+                'same source and TB_DIR at the same time.'})),
+    ('--testbed-agent', types.MappingProxyType({
+        'action': 'store_true', 'default': False,
+        'help': 'Run the many short commands that reprotest itself runs in '
+                'the testbed (e.g. to set up variations and copy files) '
+                'through a single agent process started in the testbed, '
+                'instead of starting a new process through the '
+                'virtual_server for each. This helps most with slow-to-'
+                'connect virtual_servers such as ssh. Needs python3 in the '
+                'testbed; without it, commands are run as usual.'})),
+    ('--daemon', types.MappingProxyType({
+        'default': None, 'metavar': 'SOCKET',
+        'help': 'Instead of checking anything, keep a pool of --jobs opened '
+                'testbeds of the given virtual_server ready, and run the '
+                'jobs sent with --connect to the unix socket SOCKET on them. '
+                'Testbeds are reverted (if the virtual_server supports it) '
+                'or reopened between jobs. With --testbed-agent, the '
+                'testbeds run their commands through an agent.'})),
+    ('--connect', types.MappingProxyType({
+        'default': None, 'metavar': 'SOCKET',
+        'help': 'Send the check to the reprotest --daemon listening on '
+                'SOCKET, and wait for its result. The builds run on the '
+                'daemon\'s testbeds, and their output is written to ours; '
+                'virtual_server_args are ignored, and --separate-testbeds '
+                'and --testbed-agent can\'t be used.'})),
     ('--no-clean-on-error', types.MappingProxyType({
         'action': 'store_true', 'default': False,
         'help': 'Don\'t clean the virtual_server if there was an error. '
@@ -616,6 +1100,9 @@ def command_line(*argv):
         usage='''%(prog)s --help [<virtual_server_name>]
        %(prog)s [options] auto  <source_file_or_dir> [[more options] --|--]
                  [<virtual_server_args> [<virtual_server_args> ...]]
+       %(prog)s [options] --store-dir <dir> batch <sources_list_file>
+                 [[more options] --|--]
+                 [<virtual_server_args> [<virtual_server_args> ...]]
        %(prog)s [options] <build_command> <artifact> [[more options] --|--]
                  [<virtual_server_args> [<virtual_server_args> ...]]''',
         description='Build packages and check them for reproducibility.',
@@ -672,6 +1159,29 @@ def main():
     no_clean_on_error = command_line_options.get(
         'no_clean_on_error',
         config_options.get('no_clean_on_error'))
+    concurrent_builds = command_line_options.get(
+        'concurrent_builds',
+        config_options.get('concurrent_builds'))
+    separate_testbeds = command_line_options.get(
+        'separate_testbeds',
+        config_options.get('separate_testbeds'))
+    control_cache = command_line_options.get(
+        'control_cache',
+        config_options.get('control_cache'))
+    if control_cache and not command_line_options.get('no_control_cache'):
+        control_cache = _cache.ControlCache(
+            control_cache,
+            int(command_line_options.get(
+                'control_cache_size',
+                config_options.get('control_cache_size', 1024))) * 1024 * 1024)
+    else:
+        control_cache = None
+    sync_dir = command_line_options.get(
+        'sync_dir',
+        config_options.get('sync_dir'))
+    testbed_agent = command_line_options.get(
+        'testbed_agent',
+        config_options.get('testbed_agent'))
     diffoscope_args = command_line_options.get('diffoscope_arg')
     if command_line_options.get('no_diffoscope'):
         diffoscope_args = None
@@ -690,6 +1200,15 @@ def main():
         config_options.get('verbosity', 0))
     adtlog.verbosity = verbosity
 
+    if command_line_options.get('daemon'):
+        # so that each job's output can go to its client
+        sys.stdout = daemon.ThreadOutput(sys.stdout)
+        sys.stderr = daemon.ThreadOutput(sys.stderr)
+        logging.basicConfig(
+            format='%(message)s', level=30-10*verbosity, stream=sys.stdout)
+        return daemon.serve(command_line_options['daemon'], virtual_server_args,
+                            command_line_options.get('jobs'), testbed_agent)
+
     if not build_command:
         print("No build command provided. See --help for options.")
         sys.exit(2)
@@ -706,12 +1225,61 @@ def main():
     testbed_pre = command_line_options.get("testbed_pre")
     testbed_init = command_line_options.get("testbed_init")
 
+    if build_command == 'batch':
+        if not store_dir:
+            print("Batch mode needs --store-dir for the results.")
+            sys.exit(2)
+        with open(artifact) as f:
+            sources = [l.strip() for l in f if l.strip() and not l.startswith('#')]
+        return check_batch(sources, virtual_server_args, store_dir,
+                           command_line_options.get('jobs'),
+                           command_line_options.get("auto_preset_expr"),
+                           no_clean_on_error=no_clean_on_error,
+                           variations=variations,
+                           diffoscope_args=diffoscope_args,
+                           concurrent_builds=concurrent_builds,
+                           separate_testbeds=separate_testbeds,
+                           control_cache=control_cache,
+                           sync_dir=sync_dir,
+                           testbed_agent=testbed_agent)
+
+    if command_line_options.get('connect'):
+        # these are about the testbeds, which are the daemon's
+        if separate_testbeds:
+            print("--separate-testbeds can't be used with --connect.")
+            sys.exit(2)
+        if testbed_agent:
+            print("--testbed-agent can't be used with --connect; start the "
+                  "daemon with it instead.")
+            sys.exit(2)
+        if build_command == 'auto':
+            artifact = os.path.abspath(artifact)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        reply = daemon.submit(command_line_options['connect'], {
+            'build_command': build_command,
+            'artifact': artifact,
+            'source_root': os.path.abspath(str(source_root)),
+            'variations': sorted(variations),
+            'store_dir': store_dir and os.path.abspath(str(store_dir)),
+            'diffoscope_args': diffoscope_args,
+            'testbed_pre': testbed_pre,
+            'testbed_init': testbed_init,
+            'auto_preset_expr': command_line_options.get("auto_preset_expr"),
+            'concurrent_builds': concurrent_builds,
+            'control_cache': control_cache and os.path.abspath(control_cache.cache_dir),
+            'control_cache_size': control_cache and control_cache.max_size,
+            # a path on the testbed, not relative to our cwd
+            'sync_dir': sync_dir and str(sync_dir),
+        }, (sys.stdout.fileno(), sys.stderr.fileno()))
+        if 'error' in reply:
+            print(reply['error'])
+        return reply['retcode']
+
     if build_command == 'auto':
-        source_root = os.path.normpath(os.path.dirname(artifact)) if os.path.isfile(artifact) else artifact
         auto_preset_expr = command_line_options.get("auto_preset_expr")
-        values = presets.get_presets(artifact, virtual_server_args[0])
-        values = eval(auto_preset_expr, {'_':values}, {})
-        logging.info("preset auto-selected: %r", values)
+        source_root, values = resolve_auto_preset(
+            artifact, virtual_server_args, auto_preset_expr)
         build_command = values.build_command
         artifact = values.artifact
         testbed_pre = values.testbed_pre
@@ -720,4 +1288,6 @@ def main():
     # print(build_command, artifact, virtual_server_args)
     return check(build_command, artifact, virtual_server_args, source_root,
                  no_clean_on_error, variations, store_dir, diffoscope_args,
-                 testbed_pre, testbed_init)
+                 testbed_pre, testbed_init, concurrent_builds,
+                 separate_testbeds, control_cache=control_cache,
+                 sync_dir=sync_dir, testbed_agent=testbed_agent)
@@ -0,0 +1,109 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+'''An on-disk cache of the artifacts of control builds.
+
+Entries are directories named after the hash of everything that went into
+the control build, so they never need to be invalidated, only evicted; the
+least recently used ones go first once the cache grows over its size limit.
+
+'''
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from reprotest import _treehash
+
+
+# Environment variables that differ between shells and login sessions, but
+# that builds have no business depending on. They are left out of the cache
+# key, or the cache would only ever hit from the same shell.
+VOLATILE_ENV = frozenset([
+    '_', 'OLDPWD', 'SHLVL', 'WINDOWID', 'TERM_SESSION_ID', 'XDG_SESSION_ID',
+    'SSH_AUTH_SOCK', 'SSH_AGENT_PID', 'SSH_CLIENT', 'SSH_CONNECTION', 'SSH_TTY',
+    'GPG_AGENT_INFO', 'DBUS_SESSION_BUS_ADDRESS', 'STY', 'TMUX', 'TMUX_PANE',
+])
+
+
+def du(path):
+    '''Total size in bytes of the files under path.'''
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            total += os.lstat(os.path.join(dirpath, name)).st_size
+    return total
+
+
+class ControlCache(object):
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = str(cache_dir)
+        self.max_size = max_size
+
+    def tree_digest(self, scan):
+        '''The Merkle digest of the TreeScan scan, reusing the digests of
+        unchanged files from the last time the same tree was hashed.'''
+        name = hashlib.sha256(os.path.abspath(scan.root).encode(
+            'utf-8', 'surrogateescape')).hexdigest()
+        hasher = _treehash.TreeHasher(os.path.join(self.cache_dir, '.index', name))
+        digest = hasher.digest(scan)
+        hasher.save()
+        return digest
+
+    @staticmethod
+    def key(*parts):
+        '''Hashes parts, which must be serialisable as JSON.'''
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def lookup(self, key, dest):
+        '''Copies the entry for key to dest, returning whether there was one.'''
+        entry = os.path.join(self.cache_dir, key)
+        try:
+            shutil.copytree(entry, dest, symlinks=True)
+        except FileNotFoundError:
+            logging.info("control build not found in cache %s", self.cache_dir)
+            return False
+        os.utime(entry)
+        logging.info("control build found in cache: %s", entry)
+        return True
+
+    def store(self, key, src):
+        '''Adds a copy of src as the entry for key, then evicts old entries.'''
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entry = os.path.join(self.cache_dir, key)
+        # copy to a temporary name first, so that other reprotest processes
+        # never see half of an entry
+        tmp = tempfile.mkdtemp(prefix='.tmp-', dir=self.cache_dir)
+        try:
+            shutil.copytree(src, os.path.join(tmp, key), symlinks=True)
+            os.rename(os.path.join(tmp, key), entry)
+            logging.info("control build stored in cache: %s", entry)
+        except OSError:
+            # most likely, someone else stored the same entry meanwhile
+            logging.debug("could not store %s in cache", entry, exc_info=True)
+        finally:
+            shutil.rmtree(tmp)
+        self.evict()
+
+    def evict(self):
+        '''Removes the least recently used entries until the cache fits.'''
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('.'):
+                # temporary entries, and the index of tree_digest()
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                entries.append((os.stat(path).st_mtime, du(path), path))
+            except FileNotFoundError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            logging.info("evicting %s from cache", path)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
@@ -0,0 +1,85 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+'''Quick comparison of artifact trees, so that diff or diffoscope only need
+to look at what actually differs.
+
+'''
+
+import concurrent.futures
+import mmap
+import os
+import shutil
+import stat
+
+from reprotest import _treehash
+
+CHUNK_SIZE = 1 << 20
+
+
+def same_contents(a, b, size):
+    '''Whether the files a and b, both of the given size, are identical.
+    Stops reading at the first chunk that differs.'''
+    if size == 0:
+        return True
+    with open(a, 'rb') as fa, open(b, 'rb') as fb, \
+         mmap.mmap(fa.fileno(), 0, access=mmap.ACCESS_READ) as ma, \
+         mmap.mmap(fb.fileno(), 0, access=mmap.ACCESS_READ) as mb:
+        for offset in range(0, size, CHUNK_SIZE):
+            if ma[offset:offset + CHUNK_SIZE] != mb[offset:offset + CHUNK_SIZE]:
+                return False
+    return True
+
+
+def xattrs(path):
+    '''The extended attributes of path, including ACLs, as a sorted tuple.'''
+    try:
+        names = os.listxattr(path, follow_symlinks=False)
+    except OSError:
+        # e.g. not supported by the filesystem
+        return ()
+    return tuple(sorted((name, os.getxattr(path, name, follow_symlinks=False))
+                        for name in names))
+
+
+def metadata(root, path, st):
+    '''What diff and diffoscope look at besides the contents of files.'''
+    fspath = os.path.join(root, path)
+    link = os.readlink(fspath) if stat.S_ISLNK(st.st_mode) else None
+    # cp --parents gives the directories above the artifacts a new mtime on
+    # each copy, so those of directories would never match
+    mtime = None if stat.S_ISDIR(st.st_mode) else st.st_mtime_ns
+    return (st.st_mode, st.st_uid, st.st_gid, link, mtime, xattrs(fspath),
+            st.st_size if stat.S_ISREG(st.st_mode) else None)
+
+
+def differing_files(a, b, max_workers=None):
+    '''Compares the trees a and b.
+
+    Returns:
+        None if they differ in anything but the contents of regular files,
+        e.g. in file names, types, permissions, modification times (except
+        of directories) or extended attributes. Otherwise, the sorted list of
+        (relative) paths of the files whose contents differ, which is empty
+        if the trees are identical.'''
+    trees = []
+    for root in (a, b):
+        trees.append({os.path.join(reldir, name): metadata(root, os.path.join(reldir, name), st)
+                      for reldir, entries in _treehash.TreeScan(root).dirs.items()
+                      for name, st in entries})
+    if trees[0] != trees[1]:
+        return None
+    files = [(path, m[-1]) for path, m in trees[0].items() if m[-1] is not None]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        same = executor.map(lambda f: same_contents(os.path.join(a, f[0]), os.path.join(b, f[0]), f[1]), files)
+        return sorted(path for (path, _), s in zip(files, same) if not s)
+
+
+def link_files(src, dest, paths):
+    '''Makes dest a tree of links (or copies) of just the given paths in src.'''
+    for path in paths:
+        target = os.path.join(dest, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.link(os.path.join(src, path), target)
+        except OSError:
+            shutil.copy2(os.path.join(src, path), target)
@@ -0,0 +1,133 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+'''Merkle hashing of source trees.
+
+The digest of a file is the hash of its contents, and the digest of a
+directory is the hash of the names, modes and digests of its entries.  File
+digests are remembered in an index keyed on (device, inode, mtime, size), so
+that on later runs only the files that changed are read again.
+
+'''
+
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import stat
+import tempfile
+import time
+
+# Files modified this recently might still change without their mtime
+# changing, given the timestamp granularity of some filesystems; their
+# digests are not kept in the index.
+RACY_NS = 2 * 10**9
+
+
+class TreeScan(object):
+    '''The lstat() results of everything under root.
+
+    The tree is only walked on first use, so that callers that may not need
+    it can share one scan for free.'''
+
+    def __init__(self, root):
+        self.root = root
+        self._dirs = None
+
+    @property
+    def dirs(self):
+        '''An OrderedDict of each directory (relative to root, '' for root
+        itself) to a list of (name, stat_result) for its entries. Parents
+        come before their children.'''
+        if self._dirs is None:
+            self._dirs = collections.OrderedDict()
+            todo = ['']
+            while todo:
+                reldir = todo.pop()
+                entries = []
+                for entry in os.scandir(os.path.join(self.root, reldir)):
+                    st = entry.stat(follow_symlinks=False)
+                    entries.append((entry.name, st))
+                    if stat.S_ISDIR(st.st_mode):
+                        todo.append(os.path.join(reldir, entry.name))
+                self._dirs[reldir] = entries
+        return self._dirs
+
+    def latest_mtime(self, default):
+        '''The latest modification time of anything but a directory.'''
+        return max((st.st_mtime for entries in self.dirs.values()
+                    for name, st in entries if not stat.S_ISDIR(st.st_mode)),
+                   default=default)
+
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class TreeHasher(object):
+    '''Computes Merkle digests of TreeScans, using and updating the index
+    stored in the file index_path (if given).'''
+
+    def __init__(self, index_path=None, max_workers=None):
+        self.index_path = index_path
+        self.max_workers = max_workers
+        self.index = {}
+        if index_path:
+            try:
+                with open(index_path) as f:
+                    self.index = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+    def digest(self, scan):
+        # hash the files that aren't in the index, in parallel
+        keys = {}
+        todo = []
+        for reldir, entries in scan.dirs.items():
+            for name, st in entries:
+                if stat.S_ISREG(st.st_mode):
+                    key = '%x:%x:%x:%x' % (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+                    keys[os.path.join(reldir, name)] = key
+                    if key not in self.index:
+                        todo.append((os.path.join(reldir, name), key))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            digests = executor.map(hash_file, [os.path.join(scan.root, p) for p, _ in todo])
+            found = dict(zip((key for _, key in todo), digests))
+        found.update((key, self.index[key]) for key in keys.values() if key in self.index)
+
+        # then the directories, children before their parents
+        dir_digests = {}
+        for reldir, entries in reversed(scan.dirs.items()):
+            h = hashlib.sha256()
+            for name, st in sorted(entries):
+                path = os.path.join(reldir, name)
+                if stat.S_ISREG(st.st_mode):
+                    digest = found[keys[path]]
+                elif stat.S_ISDIR(st.st_mode):
+                    digest = dir_digests[path]
+                elif stat.S_ISLNK(st.st_mode):
+                    digest = hashlib.sha256(os.fsencode(
+                        os.readlink(os.path.join(scan.root, path)))).hexdigest()
+                else:
+                    digest = ''
+                h.update(b'%s\0%o\0%s\0' % (os.fsencode(name), st.st_mode, digest.encode('ascii')))
+            dir_digests[reldir] = h.hexdigest()
+
+        # only keep what is in this tree, so the index doesn't grow forever
+        racy = int(time.time() * 10**9) - RACY_NS
+        self.index = {key: found[key] for key in keys.values()
+                      if int(key.split(':')[2], 16) < racy}
+        return dir_digests['']
+
+    def save(self):
+        if not self.index_path:
+            return
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.index_path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.index, f)
+        os.rename(tmp, self.index_path)
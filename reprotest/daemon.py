@@ -0,0 +1,273 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+'''A long-running reprotest server, that keeps a pool of opened testbeds
+ready so that each job only pays for its own builds.
+
+Jobs are sent over a unix socket, as a single line of JSON with the same
+fields as the arguments of reprotest.check(); the reply is a single line of
+JSON with the return code, and the error message if the job failed. The
+client may pass its stdout and stderr along with the job, as SCM_RIGHTS
+file descriptors; the output of the job, including that of its builds and of
+diffoscope, is then written to them instead of to the daemon's own.
+
+'''
+
+import array
+import concurrent.futures
+import itertools
+import json
+import logging
+import os
+import queue
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import traceback
+
+import reprotest
+from reprotest import _contextlib
+
+
+class TestbedPool(object):
+    '''A fixed number of opened testbeds, handed out one job at a time.
+
+    If the virtual server supports sessions, all testbeds are sessions of a
+    single server process; otherwise each has its own. A testbed that can't
+    be recycled is replaced; if that fails too, its slot stays empty (None in
+    the queue of free testbeds) until the next job that gets it tries again.'''
+
+    def __init__(self, virtual_server_args, size, temp_dir, agent=False):
+        self.virtual_server_args = virtual_server_args
+        self.temp_dir = temp_dir
+        self.agent = agent
+        # the opened testbeds, free or not; changed by the handler threads
+        self.testbeds = []
+        self.lock = threading.Lock()
+        self.counter = itertools.count(size)
+        self.free = queue.Queue()
+        self.server = reprotest.start_server(virtual_server_args, temp_dir, agent)
+        if 'sessions' not in self.server.command('capabilities', (), None):
+            self.server.stop()
+            self.server = None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=size) as executor:
+            futures = [executor.submit(self.start, n) for n in range(size)]
+        for f in futures:
+            testbed = f.result()
+            self.testbeds.append(testbed)
+            self.free.put(testbed)
+
+    def start(self, n):
+        output_dir = tempfile.mkdtemp(prefix='testbed-%s-' % n, dir=self.temp_dir)
+        if self.server:
+            testbed = self.server.new_session(output_dir)
+            testbed.open()
+            return testbed
+        return reprotest.open_testbed(self.virtual_server_args, output_dir, self.agent)
+
+    def replace(self, testbed):
+        '''Stops testbed, if not None, and starts a new one in its place.
+
+        Returns the new testbed, or None if it could not be started.'''
+        if testbed is not None:
+            with self.lock:
+                self.testbeds.remove(testbed)
+            try:
+                testbed.stop()
+            except Exception:
+                pass
+        try:
+            testbed = self.start(next(self.counter))
+        except Exception:
+            logging.warning("could not start a new testbed, trying again with the next job:\n%s",
+                            traceback.format_exc())
+            return None
+        with self.lock:
+            self.testbeds.append(testbed)
+        return testbed
+
+    @_contextlib.contextmanager
+    def testbed(self):
+        '''Waits for a free testbed and recycles it after use.'''
+        testbed = self.free.get()
+        if testbed is None:
+            testbed = self.replace(None)
+            if testbed is None:
+                self.free.put(None)
+                raise reprotest.adtlog.TestbedFailure('could not start a testbed')
+        try:
+            yield testbed
+        finally:
+            try:
+                testbed.recycle()
+            except Exception:
+                # the testbed is in an unknown state, so replace it
+                logging.warning("could not recycle testbed, starting a new one:\n%s",
+                                traceback.format_exc())
+                testbed = self.replace(testbed)
+            self.free.put(testbed)
+
+    def stop(self):
+        with self.lock:
+            testbeds = list(self.testbeds)
+        for testbed in testbeds:
+            testbed.stop()
+        if self.server:
+            self.server.stop()
+
+
+def run_job(pool, job):
+    '''Runs one job on a testbed from pool, returning the reply to send.'''
+    logging.info("job: %r", job)
+    try:
+        with pool.testbed() as testbed:
+            build_command = job['build_command']
+            artifact = job['artifact']
+            source_root = job.get('source_root')
+            testbed_pre = job.get('testbed_pre')
+            testbed_init = job.get('testbed_init')
+            if build_command == 'auto':
+                source_root, values = reprotest.resolve_auto_preset(
+                    artifact, pool.virtual_server_args,
+                    job.get('auto_preset_expr') or '_')
+                build_command = values.build_command
+                artifact = values.artifact
+                testbed_pre = values.testbed_pre
+                testbed_init = values.testbed_init
+            control_cache = job.get('control_cache')
+            if control_cache:
+                control_cache = reprotest._cache.ControlCache(
+                    control_cache, job['control_cache_size'])
+            retcode = reprotest.check(
+                build_command, artifact, pool.virtual_server_args, source_root,
+                variations=frozenset(job.get('variations', reprotest.VARIATIONS.keys())),
+                store_dir=job.get('store_dir'),
+                diffoscope_args=job.get('diffoscope_args', []),
+                testbed_pre=testbed_pre, testbed_init=testbed_init,
+                concurrent_builds=job.get('concurrent_builds', False),
+                testbed=testbed, control_cache=control_cache,
+                sync_dir=job.get('sync_dir'))
+        return {'retcode': retcode}
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return {'retcode': e.code or 0}
+        # a message, which exiting would have printed, and status 1
+        logging.error("%s", e.code)
+        return {'retcode': 1}
+    except Exception as e:
+        traceback.print_exc()
+        return {'retcode': 2, 'error': '%s: %s' % (type(e).__name__, e)}
+
+
+class ThreadOutput(object):
+    '''Stands in for sys.stdout or sys.stderr in the daemon.
+
+    What a handler thread writes goes to the file of its job, if it has one,
+    and everything else to the original stream. The file descriptor of the
+    job's file is also what reprotest.output_fd() gives subprocesses.'''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(getattr(self.local, 'file', None) or self.stream, name)
+
+
+@_contextlib.contextmanager
+def job_output(fds):
+    '''Sends what the calling thread writes to sys.stdout and sys.stderr to
+    the client's stdout and stderr fds, if it sent both.'''
+    files = [open(fd, 'w', buffering=1) for fd in fds]
+    streams = [s for s in (sys.stdout, sys.stderr) if isinstance(s, ThreadOutput)]
+    try:
+        if len(files) == 2 and len(streams) == 2:
+            for stream, f in zip(streams, files):
+                stream.local.file = f
+        yield
+    finally:
+        for stream in streams:
+            stream.local.file = None
+        for f in files:
+            f.close()
+
+
+def recv_line(sock):
+    '''Reads a line from sock, and any file descriptors sent with it.'''
+    data = b''
+    fds = array.array('i')
+    while not data.endswith(b'\n'):
+        msg, ancdata, flags, addr = sock.recvmsg(4096, socket.CMSG_SPACE(2 * fds.itemsize))
+        if not msg:
+            break
+        data += msg
+        for level, kind, cdata in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(cdata[:len(cdata) - len(cdata) % fds.itemsize])
+    return data, list(fds)
+
+
+class JobHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        line, fds = recv_line(self.request)
+        with job_output(fds):
+            try:
+                job = json.loads(line.decode('utf-8'))
+            except ValueError as e:
+                reply = {'retcode': 2, 'error': 'invalid job: %s' % e}
+            else:
+                reply = run_job(self.server.pool, job)
+        self.request.sendall(json.dumps(reply).encode('utf-8') + b'\n')
+
+
+class Daemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, pool):
+        self.pool = pool
+        super().__init__(socket_path, JobHandler)
+
+
+def interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def serve(socket_path, virtual_server_args, size=None, agent=False):
+    '''Runs the daemon until interrupted or terminated.
+
+    sys.stdout and sys.stderr should be ThreadOutputs already, so that jobs
+    can send their output to their clients.'''
+    signal.signal(signal.SIGTERM, interrupt)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        pool = TestbedPool(virtual_server_args, size or os.cpu_count(), temp_dir, agent)
+        try:
+            server = Daemon(socket_path, pool)
+            try:
+                logging.info("listening on %s with %s testbeds", socket_path, len(pool.testbeds))
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.server_close()
+                os.unlink(socket_path)
+        finally:
+            pool.stop()
+    return 0
+
+
+def submit(socket_path, job, fds=None):
+    '''Sends job to the daemon at socket_path and waits for its reply.
+
+    If fds is given, it is a (stdout, stderr) pair of file descriptors that
+    the output of the job is written to.'''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        ancdata = []
+        if fds:
+            ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))]
+        sock.sendmsg([json.dumps(job).encode('utf-8') + b'\n'], ancdata)
+        with sock.makefile('rb') as f:
+            return json.loads(f.readline().decode('utf-8'))
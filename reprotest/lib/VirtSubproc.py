@@ -32,21 +32,85 @@ import traceback
 import errno
 import time
 import pipes
+import queue
+import random
 import socket
 import shutil
+import fcntl
+import stat
+import tempfile
+import types
+import collections
+import concurrent.futures
+import heapq
+import importlib.machinery
+import itertools
+import selectors
+import threading
 
 from reprotest.lib import adtlog
 
+# ioctl to make a file share the extents of another (reflink); from linux/fs.h
+FICLONE = 0x40049409
+
 progname = "<VirtSubproc>"
 devnull_read = open('/dev/null', 'r')
 caller = __main__
 copy_timeout = int(os.getenv('ADT_VIRT_COPY_TIMEOUT', '300'))
+# auto, none, or one of COMPRESSORS
+copy_compression_setting = os.getenv('ADT_VIRT_COPY_COMPRESSION', 'auto')
+copy_compression_level = os.getenv('ADT_VIRT_COPY_COMPRESSION_LEVEL')
+
+# (compress, decompress) commands for copyup/copydown, in order of preference
+COMPRESSORS = collections.OrderedDict([
+    ('zstd', (['zstd', '-q', '-c', '-T0'], ['zstd', '-q', '-d', '-c'])),
+    ('gzip', (['gzip', '-c'], ['gzip', '-d', '-c'])),
+])
 
-downtmp_open = None  # downtmp after opening testbed
-downtmp = None  # current downtmp (None after close)
-auxverb = None  # prefix to run command argv in testbed
-cleaning = False
 in_mainloop = False
+in_process = False  # serving a client in the same process, see load_in_process()
+compress_copies = False  # set by servers for which copy bandwidth matters
+copy_methods = collections.Counter()  # how copy_file() copied, since last report
+copy_methods_lock = threading.Lock()
+ready_times = collections.OrderedDict()  # how long wait_ready() took, since last report
+ready_times_lock = threading.Lock()
+stdin_selector = None  # waits for commands on stdin, see read_command()
+stdin_buffer = b''  # what was read from stdin after the last command
+reply_lock = threading.Lock()  # for writing replies from several sessions
+
+sessions = collections.OrderedDict()  # name -> Session
+sessions_lock = threading.Lock()
+session_ids = itertools.count(1)
+
+
+class Session:
+    '''The state of one testbed
+
+    It is passed to the command handlers and to the server's hooks. A server
+    normally has a single testbed, session 0. If it defines
+    hook_new_session(session), which sets up the server's own state in a
+    new session, it can have several at once: new-session adds one, and
+    commands tagged with session=<name> run in it. Commands of different
+    sessions can run at the same time; each one holds the lock of its
+    session.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.RLock()
+        self.cleaning = False
+        self.queue = None  # its commands from stdin, see command()
+        self.reset()
+
+    def reset(self):
+        '''Forget the testbed, which is closed'''
+
+        self.downtmp_open = None  # downtmp after opening testbed
+        self.downtmp = None  # current downtmp (None after close)
+        self.auxverb = None  # prefix to run command argv in testbed
+        self.copy_compression = None  # compressor negotiated at open, if any
+        if hasattr(caller, 'hook_new_session'):
+            caller.hook_new_session(self)
 
 
 class Quit(RuntimeError):
@@ -60,17 +124,125 @@ class Timeout(RuntimeError):
     pass
 
 
-def alarm_handler(*a):
-    raise Timeout()
+class Deadline:
+    '''The timeout of one operation, see the timeout class
+
+    Each thread has a stack of the deadlines of the operations it is in, so
+    an operation is bound by its own deadline and by those of the operations
+    around it.
+    '''
+
+    def __init__(self, secs, kill=None):
+        self.at = secs and time.monotonic() + secs or None
+        self.kills = kill and [kill] or []
+        self.thread = threading.current_thread()
+        self.stack = deadline_stack()
+        self.done = False
+        self.expired = False
+        self.raised = False
+
 
+deadlines_local = threading.local()
+deadline_heap = []
+deadline_order = itertools.count()
+deadline_cond = threading.Condition()
+deadline_thread = None
 
-def timeout_start(to):
-    signal.signal(signal.SIGALRM, alarm_handler)
-    signal.alarm(to)
 
+def deadline_stack():
+    '''Return the deadlines of the operations the current thread is in'''
+
+    try:
+        return deadlines_local.stack
+    except AttributeError:
+        deadlines_local.stack = []
+        return deadlines_local.stack
+
+
+def start_deadline(secs, kill=None):
+    global deadline_thread
+
+    d = Deadline(secs, kill)
+    d.stack.append(d)
+    if d.at is not None:
+        with deadline_cond:
+            heapq.heappush(deadline_heap, (d.at, next(deadline_order), d))
+            if deadline_thread is None:
+                deadline_thread = threading.Thread(target=run_deadlines,
+                                                   name='deadlines', daemon=True)
+                deadline_thread.start()
+            deadline_cond.notify()
+    return d
 
-def timeout_stop():
-    signal.alarm(0)
+
+def stop_deadline(d):
+    '''Leave the operation of d
+
+    Return whether d or one around it has passed, and that was not reported
+    with a Timeout yet.
+    '''
+    with deadline_cond:
+        d.done = True
+    del d.stack[d.stack.index(d):]
+    passed = [e for e in d.stack + [d] if e.expired and not e.raised]
+    for e in passed:
+        e.raised = True
+    return bool(passed)
+
+
+def run_deadlines():
+    '''Expire the deadlines as they pass; runs in its own thread'''
+
+    while True:
+        with deadline_cond:
+            while True:
+                while deadline_heap and deadline_heap[0][2].done:
+                    heapq.heappop(deadline_heap)
+                if deadline_heap and deadline_heap[0][0] <= time.monotonic():
+                    d = heapq.heappop(deadline_heap)[2]
+                    d.expired = True
+                    break
+                deadline_cond.wait(deadline_heap and
+                                   deadline_heap[0][0] - time.monotonic() or None)
+        expire(d)
+
+
+def expire(d):
+    '''Stop the operation of d, and the ones inside it'''
+
+    stack = list(d.stack)
+    inner = d in stack and stack[stack.index(d):] or [d]
+    adtlog.debug('deadline of %s passed, stopping %i operations'
+                 % (d.thread.name, len(inner)))
+    for e in inner:
+        for kill in e.kills:
+            try:
+                kill()
+            except OSError:
+                pass
+    # only the main thread can be interrupted in whatever it is doing, and
+    # only if it is ours
+    if d.thread is threading.main_thread() and not in_process:
+        signal.pthread_kill(d.thread.ident, signal.SIGALRM)
+
+
+def alarm_handler(*a):
+    for d in deadline_stack():
+        if d.expired and not d.raised:
+            d.raised = True
+            raise Timeout()
+
+
+def check_deadline():
+    '''Raise Timeout if the current operation has run out of time
+
+    Loops that can't be stopped by a kill function and might run outside of
+    the main thread should call this regularly.
+    '''
+    for d in deadline_stack():
+        if d.expired and not d.raised:
+            d.raised = True
+            raise Timeout()
 
 
 class FailedCmd(RuntimeError):
@@ -99,33 +271,59 @@ def cmdnumargs(c, ce, nargs=0, noptargs=0):
         bomb("too many arguments to command `%s'" % ce[0])
 
 
-def cmd_capabilities(c, ce):
+def cmd_capabilities(session, c, ce):
     cmdnumargs(c, ce)
-    return caller.hook_capabilities()
+    # batch: commands may be tagged with id=<tag>, see command()
+    caps = caller.hook_capabilities(session) + ['batch']
+    if hasattr(caller, 'hook_new_session'):
+        caps = caps + ['sessions']
+    if session.copy_compression:
+        caps = caps + ['copy-compression=' + session.copy_compression]
+    return caps
 
 
-def cmd_quit(c, ce):
+def cmd_quit(session, c, ce):
     cmdnumargs(c, ce)
     raise Quit(0, '')
 
 
-def cmd_close(c, ce):
+def cmd_close(session, c, ce):
     cmdnumargs(c, ce)
-    if not downtmp:
+    if not session.downtmp:
         bomb("`close' when not open")
-    cleanup()
+    cleanup_session(session)
 
 
-def cmd_print_execute_command(c, ce):
-    global auxverb
+def cmd_new_session(session, c, ce):
+    '''Start a new session, which is not open yet, and return its name'''
+    cmdnumargs(c, ce)
+    if not hasattr(caller, 'hook_new_session'):
+        bomb("`new-session' when `sessions' not advertised")
+    name = str(next(session_ids))
+    new = Session(name)
+    with sessions_lock:
+        sessions[name] = new
+    return [name]
 
+
+def cmd_end_session(session, c, ce):
+    '''Close the session, if open, and forget it'''
     cmdnumargs(c, ce)
-    if not downtmp:
+    if session.name == '0':
+        bomb("the first session can only end with `quit'")
+    cleanup_session(session)
+    with sessions_lock:
+        del sessions[session.name]
+
+
+def cmd_print_execute_command(session, c, ce):
+    cmdnumargs(c, ce)
+    if not session.downtmp:
         bomb("`print-execute-command' when not open")
-    return [','.join(map(url_quote, auxverb))]
+    return [','.join(map(url_quote, session.auxverb))]
 
 
-def execute_timeout(instr, timeout, *popenargs, **popenargsk):
+def execute_timeout(instr, secs, *popenargs, **popenargsk):
     '''Popen wrapper with timeout supervision
 
     If instr is given, it is fed into stdin, otherwise stdin will be /dev/null.
@@ -139,9 +337,9 @@ def execute_timeout(instr, timeout, *popenargs, **popenargsk):
         instr = instr.encode('UTF-8')
     sp = subprocess.Popen(*popenargs,
                           **popenargsk)
-    timeout_start(timeout)
     try:
-        (out, err) = sp.communicate(instr)
+        with timeout(secs, kill=sp.kill):
+            (out, err) = sp.communicate(instr)
         if out is not None:
             out = out.decode('UTF-8', 'replace')
         if err is not None:
@@ -154,24 +352,21 @@ def execute_timeout(instr, timeout, *popenargs, **popenargsk):
             adtlog.error('WARNING: Cannot kill timed out process %s: %s' %
                          (popenargs[0], e))
         raise
-    timeout_stop()
     status = sp.wait()
     return (status, out, err)
 
 
-def check_exec(argv, downp=False, outp=False, timeout=0):
+def check_exec(argv, session=None, outp=False, timeout=0):
     '''Run successful command (argv list)
 
-    Command must succeed (exit code 0) and not produce any stderr. If downp is
-    True, command is run in testbed. If outp is True, stdout will be captured
-    and returned. stdin is set to /dev/null.
+    Command must succeed (exit code 0) and not produce any stderr. If session
+    is given, command is run in its testbed. If outp is True, stdout will be
+    captured and returned. stdin is set to /dev/null.
 
     Returns stdout (or None if outp is False).
     '''
-    global auxverb
-
-    if downp:
-        real_argv = auxverb + argv
+    if session:
+        real_argv = session.auxverb + argv
     else:
         real_argv = argv
     if outp:
@@ -184,7 +379,7 @@ def check_exec(argv, downp=False, outp=False, timeout=0):
 
     if status:
         bomb("%s%s failed (exit status %d)\n%s" %
-             ((downp and "(down) " or ""), argv, status, err))
+             ((session and "(down) " or ""), argv, status, err))
     if err:
         bomb("%s unexpectedly produced stderr output `%s'" %
              (argv, err))
@@ -195,21 +390,37 @@ def check_exec(argv, downp=False, outp=False, timeout=0):
 
 
 class timeout:
-    def __init__(self, secs, exit_msg=None):
+    def __init__(self, secs, exit_msg=None, kill=None):
         '''Context manager that times out after given number of seconds.
 
         If exit_msg is given, the program bomb()s with that message,
         otherwise it raises a Timeout exception.
+
+        Timeouts can be nested, and be used in several threads at the same
+        time. secs of 0 or None means no timeout of its own, but it is still
+        bound by the timeouts around it. When the time is up, kill (if given)
+        is called from another thread to stop the operation, as are the kill
+        functions of the timeouts inside it; the main thread is also
+        interrupted with SIGALRM, unless the server runs in its client's
+        process. Other threads only get their Timeout once they leave the
+        block, or call check_deadline().
         '''
         self.secs = secs
         self.exit_msg = exit_msg
+        self.kill = kill
 
     def __enter__(self):
-        timeout_start(self.secs)
+        if threading.current_thread() is threading.main_thread() and not in_process:
+            signal.signal(signal.SIGALRM, alarm_handler)
+        self.deadline = start_deadline(self.secs, self.kill)
 
     def __exit__(self, type_, value, traceback):
-        timeout_stop()
-        if type_ is Timeout and self.exit_msg:
+        passed = stop_deadline(self.deadline)
+        if type_ is None and passed:
+            type_ = Timeout
+            if not (self.exit_msg and self.deadline.expired):
+                raise Timeout()
+        if type_ is Timeout and self.exit_msg and self.deadline.expired:
             bomb(self.exit_msg)
             return True
         return False
@@ -221,6 +432,7 @@ def get_unix_socket(path):
     s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     with timeout(5, 'Timed out waiting for %s socket\n' % path):
         while True:
+            check_deadline()
             try:
                 s.connect(path)
                 break
@@ -229,6 +441,48 @@ def get_unix_socket(path):
     return s
 
 
+def wait_ready(probe, description, deadline, initial_delay=0.05,
+               max_delay=2.0, jitter=0.25):
+    '''Call probe() until it returns something true, and return that
+
+    Between attempts, wait for initial_delay seconds, doubling up to
+    max_delay, each shortened by a random fraction of up to jitter so that
+    several testbeds starting at once don't probe in lockstep. A Timeout
+    from probe() counts as not ready. Raises Timeout once deadline seconds
+    have passed. The time taken is recorded in ready_times.
+    '''
+    start = time.time()
+    delay = initial_delay
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            result = probe()
+        except Timeout:
+            result = None
+        elapsed = time.time() - start
+        if result:
+            adtlog.debug('%s ready after %.2fs and %i attempts'
+                         % (description, elapsed, attempts))
+            with ready_times_lock:
+                ready_times[description] = ready_times.get(description, 0) + elapsed
+            return result
+        if elapsed >= deadline:
+            adtlog.debug('%s not ready after %.2fs and %i attempts'
+                         % (description, elapsed, attempts))
+            raise Timeout()
+        time.sleep(min(delay * (1 - random.random() * jitter), deadline - elapsed))
+        delay = min(delay * 2, max_delay)
+
+
+def report_ready_times(what, start):
+    with ready_times_lock:
+        adtlog.debug('%s: testbed ready after %.2fs%s' % (
+            what, time.time() - start, ''.join(
+                ', %.2fs waiting for %s' % (t, d) for d, t in ready_times.items())))
+        ready_times.clear()
+
+
 def expect(sock, search_bytes, timeout_sec, description=None, echo=False):
     adtlog.debug('expect: "%s"' % search_bytes.decode())
     what = '"%s"' % (description or search_bytes or 'data')
@@ -236,6 +490,7 @@ def expect(sock, search_bytes, timeout_sec, description=None, echo=False):
     with timeout(timeout_sec,
                  description and ('timed out waiting for %s' % what) or None):
         while True:
+            check_deadline()
             block = sock.recv(4096)
             if not block:
                 time.sleep(0.1)
@@ -250,22 +505,66 @@ def expect(sock, search_bytes, timeout_sec, description=None, echo=False):
     return out
 
 
-def cmd_open(c, ce):
-    global auxverb, downtmp, downtmp_open
+def cmd_open(session, c, ce):
     cmdnumargs(c, ce)
-    if downtmp:
+    if session.downtmp:
         bomb("`open' when already open")
-    caller.hook_open()
-    adtlog.debug("auxverb = %s, downtmp = %s" % (str(auxverb), downtmp))
-    downtmp = caller.hook_downtmp(downtmp_open)
-    if downtmp_open and downtmp_open != downtmp:
+    start = time.time()
+    caller.hook_open(session)
+    report_ready_times('open', start)
+    adtlog.debug("auxverb = %s, downtmp = %s" % (str(session.auxverb), session.downtmp))
+    session.downtmp = caller.hook_downtmp(session, session.downtmp_open)
+    if session.downtmp_open and session.downtmp_open != session.downtmp:
         bomb('virt-runner failed to restore downtmp path %s, gave %s instead'
-             % (downtmp_open, downtmp))
-    downtmp_open = downtmp
-    return [downtmp]
+             % (session.downtmp_open, session.downtmp))
+    session.downtmp_open = session.downtmp
+    negotiate_copy_compression(session)
+    return [session.downtmp]
+
+
+def negotiate_copy_compression(session):
+    '''Choose a compressor for copies that both the host and testbed have'''
+
+    session.copy_compression = None
+    if not compress_copies or copy_compression_setting == 'none':
+        return
+    if copy_compression_setting == 'auto':
+        wanted = list(COMPRESSORS)
+    elif copy_compression_setting in COMPRESSORS:
+        wanted = [copy_compression_setting]
+    else:
+        bomb('unknown ADT_VIRT_COPY_COMPRESSION %s, must be one of: auto, none, %s'
+             % (copy_compression_setting, ', '.join(COMPRESSORS)))
+    (status, out, err) = execute_timeout(
+        None, 30, session.auxverb + ['sh', '-c', 'for c in %s; do command -v $c >/dev/null && echo $c; done; true'
+                             % ' '.join(wanted)],
+        stdout=subprocess.PIPE)
+    available = (out or '').split()
+    for c in wanted:
+        if c in available and shutil.which(c):
+            session.copy_compression = c
+            break
+    adtlog.debug('copy compression: %s (testbed has: %s)'
+                 % (session.copy_compression, ' '.join(available)))
+
+
+def copy_compression_commands(session):
+    '''Return (compress, decompress) argvs for the copy_compression of session'''
 
+    compress, decompress = COMPRESSORS[session.copy_compression]
+    if copy_compression_level:
+        compress = compress + ['-' + copy_compression_level]
+    return compress, decompress
 
-def downtmp_mktemp(path):
+
+def sh_pipeline(source, sink):
+    '''"source | sink" in POSIX sh, but failing if either of them fails'''
+
+    return ('{ s=$( { { %s; echo $? >&4; } | %s >&3; } 4>&1 ); } 3>&1; [ "$s" = 0 ]'
+            % (source, sink))
+
+
+def downtmp_mktemp(session, path):
     '''Generate a downtmp
 
     When a path is given, this is the downtmp that we created when opening the
@@ -274,47 +573,46 @@ def downtmp_mktemp(path):
     fail if they get moved around.
     '''
     if path:
-        check_exec(['mkdir', '--mode=1777', '--parents', downtmp_open],
-                   downp=True)
+        check_exec(['mkdir', '--mode=1777', '--parents', path],
+                   session=session)
         return path
     else:
         d = check_exec(['mktemp', '--directory', '--tmpdir', 'autopkgtest.XXXXXX'],
-                       downp=True, outp=True)
-        check_exec(['chmod', '1777', d], downp=True)
+                       session=session, outp=True)
+        check_exec(['chmod', '1777', d], session=session)
         return d
 
 
-def downtmp_remove():
-    global downtmp, auxverb
-    if downtmp:
+def downtmp_remove(session):
+    if session.downtmp:
         execute_timeout(None, copy_timeout,
-                        auxverb + ['rm', '-rf', '--', downtmp])
-        downtmp = None
+                        session.auxverb + ['rm', '-rf', '--', session.downtmp])
+        session.downtmp = None
 
 
-def cmd_revert(c, ce):
-    global auxverb, downtmp, downtmp_open
+def cmd_revert(session, c, ce):
     cmdnumargs(c, ce)
-    if not downtmp:
+    if not session.downtmp:
         bomb("`revert' when not open")
-    if 'revert' not in caller.hook_capabilities():
+    if 'revert' not in caller.hook_capabilities(session):
         bomb("`revert' when `revert' not advertised")
-    caller.hook_revert()
-    downtmp = caller.hook_downtmp(downtmp_open)
-    if downtmp_open and downtmp_open != downtmp:
+    start = time.time()
+    caller.hook_revert(session)
+    report_ready_times('revert', start)
+    session.downtmp = caller.hook_downtmp(session, session.downtmp_open)
+    if session.downtmp_open and session.downtmp_open != session.downtmp:
         bomb('virt-runner failed to restore downtmp path %s, gave %s instead'
-             % (downtmp_open, downtmp))
-    adtlog.debug("auxverb = %s, downtmp = %s" % (str(auxverb), downtmp))
+             % (session.downtmp_open, session.downtmp))
+    adtlog.debug("auxverb = %s, downtmp = %s" % (str(session.auxverb), session.downtmp))
 
-    return [downtmp]
+    return [session.downtmp]
 
 
-def cmd_reboot(c, ce):
-    global downtmp
+def cmd_reboot(session, c, ce):
     cmdnumargs(c, ce, 0, 1)
-    if not downtmp:
+    if not session.downtmp:
         bomb("`reboot' when not open")
-    if 'reboot' not in caller.hook_capabilities():
+    if 'reboot' not in caller.hook_capabilities(session):
         bomb("`reboot' when `reboot' not advertised")
 
     # save current downtmp; try a few locations, as /var/cache might be r/o
@@ -324,12 +622,12 @@ def cmd_reboot(c, ce):
                 '  tar --warning=none --create --absolute-names '
                 '''    -f $d/autopkgtest-tmpdir.tar '%s'; '''
                 '  rm -f /run/autopkgtest-reboot-prepare-mark; '
-                '  exit 0; fi; done; exit 1''' % (directories, downtmp)],
-               downp=True, timeout=copy_timeout)
+                '  exit 0; fi; done; exit 1''' % (directories, session.downtmp)],
+               session=session, timeout=copy_timeout)
     adtlog.debug('cmd_reboot: saved current downtmp, rebooting')
 
     try:
-        caller.hook_prepare_reboot()
+        caller.hook_prepare_reboot(session)
     except AttributeError:
         pass
 
@@ -337,9 +635,11 @@ def cmd_reboot(c, ce):
     if len(c) > 1 and c[1] == 'prepare-only':
         adtlog.info('state saved, waiting for testbed to reboot...')
     else:
-        execute_timeout(None, 30, auxverb +
+        execute_timeout(None, 30, session.auxverb +
                         ['sh', '-c', '(sleep 3; reboot) >/dev/null 2>&1 &'])
-    caller.hook_wait_reboot()
+    start = time.time()
+    caller.hook_wait_reboot(session)
+    report_ready_times('reboot', start)
 
     # restore downtmp
     check_exec(['sh', '-ec', 'for d in %s; do '
@@ -348,33 +648,151 @@ def cmd_reboot(c, ce):
                 '     -f $d/autopkgtest-tmpdir.tar;'
                 ' rm $d/autopkgtest-tmpdir.tar; exit 0; '
                 'fi; done; exit 1' % directories],
-               downp=True, timeout=copy_timeout)
+               session=session, timeout=copy_timeout)
     adtlog.debug('cmd_reboot: restored downtmp after reboot')
 
 
-def get_downtmp_host():
+def get_downtmp_host(session):
     '''Return host directory of the testbed's downtmp dir, if supported'''
 
-    for cap in caller.hook_capabilities():
+    for cap in caller.hook_capabilities(session):
         if cap.startswith('downtmp-host='):
             return cap.split('=', 1)[1]
     return None
 
 
-def copytree(src, dst):
-    '''Like shutils.copytree(), but merges with existing dst'''
+def copy_file(src, dst):
+    '''Copy the contents of file src to dst as cheaply as possible
 
-    if not os.path.exists(dst):
-        shutil.copytree(src, dst, symlinks=True)
-        return
+    This tries a reflink first, which shares the data on btrfs/XFS, then
+    copy_file_range(), which at least avoids the round trip through user
+    space, and then falls back to a normal copy.
+    '''
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        method = 'copy'
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            method = 'reflink'
+        except OSError:
+            if hasattr(os, 'copy_file_range'):
+                try:
+                    while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+                        pass
+                    method = 'copy_file_range'
+                except OSError:
+                    # e.g. EXDEV on older kernels; start over
+                    fsrc.seek(0)
+                    fdst.seek(0)
+                    fdst.truncate()
+            if method == 'copy':
+                shutil.copyfileobj(fsrc, fdst, 1 << 20)
+    with copy_methods_lock:
+        copy_methods[method] += 1
+
+
+def copy(src, dst):
+    '''Like shutil.copy(), but using copy_file()'''
+
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    copy_file(src, dst)
+    shutil.copymode(src, dst)
+    return dst
+
+
+def copy2(src, dst):
+    '''Like shutil.copy2(), but using copy_file()'''
+
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    copy_file(src, dst)
+    shutil.copystat(src, dst)
+    return dst
+
+
+def report_copy_methods(what):
+    if copy_methods:
+        adtlog.debug('%s: copied %s' % (what, ', '.join(
+            '%i files with %s' % (n, m) for m, n in sorted(copy_methods.items()))))
+        copy_methods.clear()
+
+
+def copytree(src, dst, max_workers=None):
+    '''Like shutils.copytree(), but merges with existing dst
+
+    Like cp -r --preserve=timestamps,links, this keeps symlinks as they are
+    and preserves timestamps and hard links. The files are copied in parallel
+    by a pool of max_workers threads. Symlinks below dst are never followed,
+    so nothing is written outside of it; they are replaced by the files that
+    are copied over them, and are an error where a directory is copied.
+    '''
+    errors = []
+    dirs = []  # (src, dst), parents first
+    files = []  # (src, dst)
+    links = []  # (first copy, dst) for hard links
+    inodes = {}
 
-    for f in os.listdir(src):
-        fsrc = os.path.join(src, f)
-        subprocess.check_call(['cp', '-r', '--preserve=timestamps,links',
-                               '--target-directory', dst, fsrc])
+    def lmode(path):
+        try:
+            return os.lstat(path).st_mode
+        except FileNotFoundError:
+            return None
+
+    def walk(s, d):
+        dirs.append((s, d))
+        for entry in os.scandir(s):
+            target = os.path.join(d, entry.name)
+            try:
+                st = entry.stat(follow_symlinks=False)
+                mode = lmode(target)
+                if entry.is_dir(follow_symlinks=False):
+                    if mode is None:
+                        os.mkdir(target)
+                    elif not stat.S_ISDIR(mode):
+                        raise OSError(errno.ENOTDIR, 'cannot overwrite non-directory '
+                                      'with directory', target)
+                    walk(entry.path, target)
+                    continue
+                if mode is not None:
+                    if stat.S_ISDIR(mode):
+                        raise OSError(errno.EISDIR, 'cannot overwrite directory '
+                                      'with non-directory', target)
+                    os.unlink(target)
+                if entry.is_symlink():
+                    os.symlink(os.readlink(entry.path), target)
+                    os.utime(target, ns=(st.st_atime_ns, st.st_mtime_ns),
+                             follow_symlinks=False)
+                elif st.st_nlink > 1 and (st.st_dev, st.st_ino) in inodes:
+                    links.append((inodes[(st.st_dev, st.st_ino)], target))
+                else:
+                    inodes[(st.st_dev, st.st_ino)] = target
+                    files.append((entry.path, target))
+            except OSError as why:
+                errors.append((entry.path, target, str(why)))
+
+    os.makedirs(dst, exist_ok=True)
+    walk(src, dst)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [(s, d, executor.submit(copy2, s, d)) for s, d in files]
+    for s, d, f in futures:
+        if f.exception():
+            errors.append((s, d, str(f.exception())))
+    for first, d in links:
+        try:
+            os.link(first, d)
+        except OSError as why:
+            errors.append((first, d, str(why)))
+    # only now that their contents are complete
+    for s, d in reversed(dirs):
+        try:
+            shutil.copystat(s, d)
+        except OSError as why:
+            errors.append((s, d, str(why)))
+    if errors:
+        raise shutil.Error(errors)
 
 
-def copyup_shareddir(tb, host, is_dir, downtmp_host):
+def copyup_shareddir(session, tb, host, is_dir, downtmp_host):
     adtlog.debug('copyup_shareddir: tb %s host %s is_dir %s downtmp_host %s'
                  % (tb, host, is_dir, downtmp_host))
 
@@ -382,39 +800,39 @@ def copyup_shareddir(tb, host, is_dir, downtmp_host):
     tb = os.path.normpath(tb)
     downtmp_host = os.path.normpath(downtmp_host)
 
-    timeout_start(copy_timeout)
     try:
-        tb_tmp = None
-        if tb.startswith(downtmp):
-            # translate into host path
-            tb = downtmp_host + tb[len(downtmp):]
-        else:
-            tb_tmp = os.path.join(downtmp, os.path.basename(host))
-            adtlog.debug('copyup_shareddir: tb path %s is not already in '
-                         'downtmp, copying to %s' % (tb, tb_tmp))
-            check_exec(['cp', '-r', '--preserve=timestamps,links', tb, tb_tmp],
-                       downp=True)
-            # translate into host path
-            tb = os.path.join(downtmp_host, os.path.basename(host))
-
-        if tb == host:
+        with timeout(copy_timeout):
             tb_tmp = None
-        else:
-            adtlog.debug('copyup_shareddir: tb(host) %s is not already at '
-                         'destination %s, copying' % (tb, host))
-            if is_dir:
-                copytree(tb, host)
+            if tb.startswith(session.downtmp):
+                # translate into host path
+                tb = downtmp_host + tb[len(session.downtmp):]
             else:
-                shutil.copy(tb, host)
-
-        if tb_tmp:
-            adtlog.debug('copyup_shareddir: rm intermediate copy: %s' % tb)
-            check_exec(['rm', '-rf', tb_tmp], downp=True)
+                tb_tmp = os.path.join(session.downtmp, os.path.basename(host))
+                adtlog.debug('copyup_shareddir: tb path %s is not already in '
+                             'downtmp, copying to %s' % (tb, tb_tmp))
+                check_exec(['cp', '-r', '--preserve=timestamps,links', '--reflink=auto',
+                            tb, tb_tmp], session=session)
+                # translate into host path
+                tb = os.path.join(downtmp_host, os.path.basename(host))
+
+            if tb == host:
+                tb_tmp = None
+            else:
+                adtlog.debug('copyup_shareddir: tb(host) %s is not already at '
+                             'destination %s, copying' % (tb, host))
+                if is_dir:
+                    copytree(tb, host)
+                else:
+                    copy(tb, host)
+
+            if tb_tmp:
+                adtlog.debug('copyup_shareddir: rm intermediate copy: %s' % tb)
+                check_exec(['rm', '-rf', tb_tmp], session=session)
     finally:
-        timeout_stop()
+        report_copy_methods('copyup_shareddir')
 
 
-def copydown_shareddir(host, tb, is_dir, downtmp_host):
+def copydown_shareddir(session, host, tb, is_dir, downtmp_host):
     adtlog.debug('copydown_shareddir: host %s tb %s is_dir %s downtmp_host %s'
                  % (host, tb, is_dir, downtmp_host))
 
@@ -422,61 +840,61 @@ def copydown_shareddir(host, tb, is_dir, downtmp_host):
     tb = os.path.normpath(tb)
     downtmp_host = os.path.normpath(downtmp_host)
 
-    timeout_start(copy_timeout)
     try:
-        host_tmp = None
-        if host.startswith(downtmp_host):
-            # translate into tb path
-            host = downtmp + host[len(downtmp_host):]
-        else:
-            host_tmp = os.path.join(downtmp_host, os.path.basename(tb))
-            if is_dir:
-                if os.path.exists(host_tmp):
-                    try:
-                        shutil.rmtree(host_tmp)
-                    except OSError as e:
-                        adtlog.warning('cannot remove old %s, moving it '
-                                       'instead: %s' % (host_tmp, e))
-                        # some undeletable files? hm, move it aside instead
-                        counter = 0
-                        while True:
-                            p = host_tmp + '.old%i' % counter
-                            if not os.path.exists(p):
-                                os.rename(host_tmp, p)
-                                break
-                            counter += 1
-
-                shutil.copytree(host, host_tmp, symlinks=True)
-            else:
-                shutil.copy(host, host_tmp)
-            # translate into tb path
-            host = os.path.join(downtmp, os.path.basename(tb))
-
-        if host == tb:
+        with timeout(copy_timeout):
             host_tmp = None
-        else:
-            check_exec(['rm', '-rf', tb], downp=True)
-            check_exec(['cp', '-r', '--preserve=timestamps,links', host, tb],
-                       downp=True)
-        if host_tmp:
-            (is_dir and shutil.rmtree or os.unlink)(host_tmp)
+            if host.startswith(downtmp_host):
+                # translate into tb path
+                host = session.downtmp + host[len(downtmp_host):]
+            else:
+                host_tmp = os.path.join(downtmp_host, os.path.basename(tb))
+                if is_dir:
+                    if os.path.exists(host_tmp):
+                        try:
+                            shutil.rmtree(host_tmp)
+                        except OSError as e:
+                            adtlog.warning('cannot remove old %s, moving it '
+                                           'instead: %s' % (host_tmp, e))
+                            # some undeletable files? hm, move it aside instead
+                            counter = 0
+                            while True:
+                                p = host_tmp + '.old%i' % counter
+                                if not os.path.exists(p):
+                                    os.rename(host_tmp, p)
+                                    break
+                                counter += 1
+
+                    copytree(host, host_tmp)
+                else:
+                    copy(host, host_tmp)
+                # translate into tb path
+                host = os.path.join(session.downtmp, os.path.basename(tb))
+
+            if host == tb:
+                host_tmp = None
+            else:
+                check_exec(['rm', '-rf', tb], session=session)
+                check_exec(['cp', '-r', '--preserve=timestamps,links', '--reflink=auto',
+                            host, tb], session=session)
+            if host_tmp:
+                (is_dir and shutil.rmtree or os.unlink)(host_tmp)
     finally:
-        timeout_stop()
+        report_copy_methods('copydown_shareddir')
 
 
-def copyupdown(c, ce, upp):
+def copyupdown(session, c, ce, upp):
     cmdnumargs(c, ce, 2)
-    copyupdown_internal(ce[0], c[1:], upp)
+    copyupdown_internal(session, ce[0], c[1:], upp)
 
 
-def copyupdown_internal(wh, sd, upp):
+def copyupdown_internal(session, wh, sd, upp):
     '''Copy up/down a file or dir.
 
     wh: 'copyup' or 'copydown'
     sd: (source, destination) paths
     upp: True for copyup, False for copydown
     '''
-    if not downtmp:
+    if not session.downtmp:
         bomb("%s when not open" % wh)
     if not sd[0] or not sd[1]:
         bomb("%s paths must be nonempty" % wh)
@@ -487,13 +905,13 @@ def copyupdown_internal(wh, sd, upp):
 
     # if we have a shared directory, we just need to copy it from/to there; in
     # most cases, it's testbed end is already in the downtmp dir
-    downtmp_host = get_downtmp_host()
+    downtmp_host = get_downtmp_host(session)
     if downtmp_host:
         try:
             if upp:
-                copyup_shareddir(sd[0], sd[1], dirsp, downtmp_host)
+                copyup_shareddir(session, sd[0], sd[1], dirsp, downtmp_host)
             else:
-                copydown_shareddir(sd[0], sd[1], dirsp, downtmp_host)
+                copydown_shareddir(session, sd[0], sd[1], dirsp, downtmp_host)
             return
         except Timeout:
             raise FailedCmd(['timeout'])
@@ -509,8 +927,16 @@ def copyupdown_internal(wh, sd, upp):
     deststdout = devnull_read
     srcstdin = devnull_read
     remfileq = pipes.quote(sd[iremote])
+    copy_compression = session.copy_compression
+    if copy_compression:
+        compress, decompress = copy_compression_commands(session)
+        adtlog.debug('%s: compressing with %s' % (wh, copy_compression))
     if not dirsp:
-        rune = 'cat %s%s' % ('><'[upp], remfileq)
+        if copy_compression:
+            remote, localcmdl = upp and (compress, decompress) or (decompress, compress)
+        else:
+            remote, localcmdl = ['cat'], ['cat']
+        rune = '%s %s%s' % (' '.join(map(pipes.quote, remote)), '><'[upp], remfileq)
         if upp:
             deststdout = open(sd[idst], 'w')
         else:
@@ -518,14 +944,28 @@ def copyupdown_internal(wh, sd, upp):
             status = os.fstat(srcstdin.fileno())
             if status.st_mode & 0o111:
                 rune += '; chmod +x -- %s' % (remfileq)
-        localcmdl = ['cat']
     else:
         taropts = [None, None]
         taropts[isrc] = '--warning=none -c .'
         taropts[idst] = '--warning=none --preserve-permissions --extract ' \
                         '--no-same-owner'
 
-        rune = 'cd %s; tar %s -f -' % (remfileq, taropts[iremote])
+        remote_tar = 'tar %s -f -' % taropts[iremote]
+        local_tar = ['tar', '--directory', sd[ilocal]] + (
+            ('%s -f -' % taropts[ilocal]).split()
+        )
+        if copy_compression:
+            quote = lambda argv: ' '.join(map(pipes.quote, argv))
+            if upp:
+                remote_tar = sh_pipeline(remote_tar, quote(compress))
+                localcmdl = ['sh', '-ec', sh_pipeline(quote(decompress), quote(local_tar))]
+            else:
+                remote_tar = sh_pipeline(quote(decompress), remote_tar)
+                localcmdl = ['sh', '-ec', sh_pipeline(quote(local_tar), quote(compress))]
+        else:
+            localcmdl = local_tar
+
+        rune = 'cd %s; %s' % (remfileq, remote_tar)
         if upp:
             try:
                 os.mkdir(sd[ilocal])
@@ -536,17 +976,19 @@ def copyupdown_internal(wh, sd, upp):
             rune = ('if ! test -d %s; then mkdir -- %s; fi; ' % (
                 remfileq, remfileq)
             ) + rune
-
-        localcmdl = ['tar', '--directory', sd[ilocal]] + (
-            ('%s -f -' % taropts[ilocal]).split()
-        )
-    downcmdl = auxverb + ['sh', '-ec', rune]
+    downcmdl = session.auxverb + ['sh', '-ec', rune]
 
     if upp:
         cmdls = (downcmdl, localcmdl)
     else:
         cmdls = (localcmdl, downcmdl)
 
+    run_pipe(wh, cmdls, srcstdin, deststdout)
+
+
+def run_pipe(wh, cmdls, srcstdin=devnull_read, deststdout=devnull_read):
+    '''Run cmdls[0] | cmdls[1], under the copy timeout'''
+
     adtlog.debug(str(["cmdls", str(cmdls)]))
     adtlog.debug(str(["srcstdin", str(srcstdin), "deststdout",
                       str(deststdout), "devnull_read", devnull_read]))
@@ -559,16 +1001,19 @@ def copyupdown_internal(wh, sd, upp):
     subprocs[1] = subprocess.Popen(cmdls[1], stdin=subprocs[0].stdout,
                                    stdout=deststdout)
     subprocs[0].stdout.close()
+
+    def kill():
+        for sp in subprocs:
+            sp.kill()
+
     try:
-        timeout_start(copy_timeout)
-        for sdn in [1, 0]:
-            adtlog.debug(" +" + "<>"[sdn] + "?")
-            status = subprocs[sdn].wait()
-            if not (status == 0 or (sdn == 0 and status == -13)):
-                timeout_stop()
-                bomb("%s %s failed, status %d" %
-                     (wh, ['source', 'destination'][sdn], status))
-        timeout_stop()
+        with timeout(copy_timeout, kill=kill):
+            for sdn in [1, 0]:
+                adtlog.debug(" +" + "<>"[sdn] + "?")
+                status = subprocs[sdn].wait()
+                if not (status == 0 or (sdn == 0 and status == -13)):
+                    bomb("%s %s failed, status %d" %
+                         (wh, ['source', 'destination'][sdn], status))
     except Timeout:
         for sdn in [1, 0]:
             subprocs[sdn].kill()
@@ -576,21 +1021,138 @@ def copyupdown_internal(wh, sd, upp):
         raise FailedCmd(['timeout'])
 
 
-def cmd_copydown(c, ce):
-    copyupdown(c, ce, False)
+def manifest(root):
+    '''Describe the tree at root, as the find command in cmd_syncdown does'''
+
+    entries = {}
+    todo = [b'']
+    while todo:
+        rel = todo.pop()
+        path = os.path.join(root, rel)
+        st = os.lstat(path)
+        mtime = int(st.st_mtime)
+        mode = stat.S_IMODE(st.st_mode)
+        if stat.S_ISDIR(st.st_mode):
+            entries[rel] = (b'd', None, mtime, mode, None)
+            todo.extend(os.path.join(rel, n) for n in os.listdir(path))
+        elif stat.S_ISREG(st.st_mode):
+            entries[rel] = (b'f', st.st_size, mtime, mode, None)
+        elif stat.S_ISLNK(st.st_mode):
+            entries[rel] = (b'l', None, None, None, os.readlink(path))
+        else:
+            entries[rel] = (b'?', None, None, None, None)
+    return entries
+
+
+def testbed_manifest(session, tb):
+    '''Describe the tree at tb in the testbed, creating it if necessary'''
 
+    tbq = pipes.quote(tb)
+    sp = subprocess.Popen(session.auxverb + [
+        'sh', '-ec', 'mkdir -p %s; cd %s; find . -printf "%%y\\0%%s\\0%%T@\\0%%m\\0%%P\\0%%l\\0"'
+        % (tbq, tbq)], stdin=devnull_read, stdout=subprocess.PIPE)
+    try:
+        with timeout(copy_timeout, kill=sp.kill):
+            out = sp.communicate()[0]
+    except Timeout:
+        sp.kill()
+        sp.wait()
+        raise FailedCmd(['timeout'])
+    if sp.returncode != 0:
+        bomb('syncdown: cannot list %s, status %d' % (tb, sp.returncode))
+    entries = {}
+    fields = out.split(b'\0')
+    for i in range(0, len(fields) - 1, 6):
+        (ftype, size, mtime, mode, path, link) = fields[i:i + 6]
+        if ftype == b'd':
+            entries[path] = (b'd', None, int(float(mtime)), int(mode, 8), None)
+        elif ftype == b'f':
+            entries[path] = (b'f', int(size), int(float(mtime)), int(mode, 8), None)
+        elif ftype == b'l':
+            entries[path] = (b'l', None, None, None, link)
+        else:
+            entries[path] = (b'?', None, None, None, None)
+    return entries
 
-def cmd_copyup(c, ce):
-    copyupdown(c, ce, True)
 
+def cmd_syncdown(session, c, ce):
+    '''Make a directory in the testbed the same as one on the host
 
-def cmd_shell(c, ce):
+    Unlike copydown, this only transfers what is missing or has a different
+    type, size, mtime or mode in the testbed, and removes what is no longer
+    on the host, so it is cheap to keep a copy of a tree up to date.
+    Returns the number of entries transferred and removed.
+    '''
+    cmdnumargs(c, ce, 2)
+    if not session.downtmp:
+        bomb("syncdown when not open")
+    host, tb = c[1], c[2]
+    if host[-1:] != '/' or tb[-1:] != '/':
+        bomb("syncdown paths must be directories (with a trailing /)")
+
+    hostm = manifest(os.fsencode(host))
+    tbm = testbed_manifest(session, tb)
+    removed = sorted(p for p in tbm if p not in hostm or tbm[p][0] != hostm[p][0])
+    sent = set(p for p in hostm if tbm.get(p) != hostm[p])
+    # directories get a new mtime when their entries change; send them too,
+    # so that tar restores it
+    for p in list(sent) + removed:
+        while p:
+            p = os.path.dirname(p)
+            if p in hostm:
+                sent.add(p)
+    adtlog.debug('syncdown: %i entries, sending %i, removing %i'
+                 % (len(hostm), len(sent), len(removed)))
+
+    if removed:
+        # execute_timeout() only feeds text; the names are bytes
+        sp = subprocess.Popen(session.auxverb + [
+            'sh', '-ec', 'cd %s; xargs -0 rm -rf --' % pipes.quote(tb)],
+            stdin=subprocess.PIPE)
+        try:
+            with timeout(copy_timeout, kill=sp.kill):
+                sp.communicate(b''.join(b'./' + p + b'\0' for p in removed))
+        except Timeout:
+            sp.kill()
+            sp.wait()
+            raise FailedCmd(['timeout'])
+        if sp.returncode != 0:
+            bomb('syncdown: removing stale files failed, status %d' % sp.returncode)
+    if not sent:
+        return ['0', str(len(removed))]
+
+    with tempfile.NamedTemporaryFile(prefix='syncdown-') as names:
+        # ./ so that tar doesn't take names starting with - as options
+        names.write(b''.join(b'./' + p + b'\0' for p in sorted(sent)))
+        names.flush()
+        local_tar = ['tar', '--directory', host, '--no-recursion', '--null',
+                     '-T', names.name, '--warning=none', '-c', '-f', '-']
+        remote_tar = 'tar --warning=none --preserve-permissions --extract --no-same-owner -f -'
+        if session.copy_compression:
+            compress, decompress = copy_compression_commands(session)
+            quote = lambda argv: ' '.join(map(pipes.quote, argv))
+            remote_tar = sh_pipeline(quote(decompress), remote_tar)
+            local_tar = ['sh', '-ec', sh_pipeline(quote(local_tar), quote(compress))]
+        run_pipe('syncdown', (local_tar, session.auxverb + [
+            'sh', '-ec', 'cd %s; %s' % (pipes.quote(tb), remote_tar)]))
+    return [str(len(sent)), str(len(removed))]
+
+
+def cmd_copydown(session, c, ce):
+    copyupdown(session, c, ce, False)
+
+
+def cmd_copyup(session, c, ce):
+    copyupdown(session, c, ce, True)
+
+
+def cmd_shell(session, c, ce):
     cmdnumargs(c, ce, 1, None)
-    if not downtmp:
+    if not session.downtmp:
         bomb("`shell' when not open")
     # runners can provide a hook if they need a special treatment
     try:
-        caller.hook_shell(*c[1:])
+        caller.hook_shell(session, *c[1:])
     except AttributeError:
         adtlog.debug('cmd_shell: using default shell command, dir %s' % c[1])
         cmd = 'cd "%s"; ' % c[1]
@@ -606,32 +1168,44 @@ def cmd_shell(c, ce):
             with open('/dev/tty', 'rb') as sin:
                 with open('/dev/tty', 'wb') as sout:
                     with open('/dev/tty', 'wb') as serr:
-                        subprocess.call(auxverb + ['sh', '-c', cmd],
+                        subprocess.call(session.auxverb + ['sh', '-c', cmd],
                                         stdin=sin, stdout=sout, stderr=serr)
         except (OSError, IOError) as e:
             adtlog.error('Cannot run shell: %s' % e)
 
 
-def command():
-    sys.stdout.flush()
-    while True:
+def read_command():
+    '''Wait for the next line on stdin and return it, or None at EOF
+
+    This reads stdin directly, waiting with a selector, so that each command
+    is seen as soon as it arrives, even if stdin was made non-blocking.
+    '''
+    global stdin_selector, stdin_buffer
+    fd = sys.stdin.fileno()
+    if stdin_selector is None:
+        stdin_selector = selectors.DefaultSelector()
         try:
-            ce = sys.stdin.readline().strip()
-            # FIXME: This usually means EOF (as checked below), but with Python
-            # 3 we often get empty strings here even though this is supposed to
-            # block for new input.
-            if ce == '':
-                time.sleep(0.1)
-                continue
-            break
-        except IOError as e:
-            if e.errno == errno.EAGAIN:
-                time.sleep(0.1)
-                continue
-            else:
-                raise
-    if not ce:
-        bomb('end of file - caller quit?')
+            stdin_selector.register(fd, selectors.EVENT_READ)
+        except (OSError, ValueError):
+            # e.g. a regular file, which is always ready anyway
+            adtlog.debug('cannot wait for commands on stdin, reading it directly')
+    while b'\n' not in stdin_buffer:
+        if stdin_selector.get_map():
+            stdin_selector.select()
+        try:
+            block = os.read(fd, 65536)
+        except BlockingIOError:
+            continue
+        if not block:
+            line, stdin_buffer = stdin_buffer, b''
+            return line.decode() if line else None
+        stdin_buffer += block
+    line, stdin_buffer = stdin_buffer.split(b'\n', 1)
+    return line.decode()
+
+
+def dispatch(session, ce):
+    '''Run the command line ce in session, and return the reply line'''
     ce = ce.rstrip().split()
     c = list(map(url_unquote, ce))
     if not c:
@@ -643,13 +1217,133 @@ def command():
     except KeyError:
         bomb("unknown command `%s'" % ce[0])
     try:
-        r = f(c, ce)
+        r = f(session, c, ce)
         if not r:
             r = []
         r.insert(0, 'ok')
     except FailedCmd as fc:
         r = fc.e
-    print(' '.join(r))
+    return ' '.join(r)
+
+
+def command():
+    '''Run the next command from stdin
+
+    A command may start with a tag id=<tag>, which is then put in front of
+    its reply, so that a client can send several commands at once and match
+    the replies to them. The commands of one session are run one after the
+    other.
+
+    After that, a tag session=<name> runs the command in a session from
+    new-session; without it, commands run in the first session. The commands
+    of a session from new-session run in a thread of that session, so they
+    don't wait for those of other sessions, and their replies can come in
+    a different order than the commands; clients that use several sessions
+    at once tag their commands with ids. If a command fails in a session
+    from new-session, only that session is cleaned up, and the reply is
+    "error <message>"; the server carries on with the others.
+    '''
+    sys.stdout.flush()
+    while True:
+        ce = read_command()
+        if ce is None:
+            bomb('end of file - caller quit?')
+        if ce.strip():
+            break
+    received = time.monotonic()
+    with sessions_lock:
+        session = sessions.get(parse_tags(ce)[1])
+    if session is None or session.name == '0':
+        # unknown sessions fail in handle_line(), like any bad command
+        send_reply(handle_line(ce, received))
+        return
+    if session.queue is None:
+        session.queue = queue.Queue()
+        threading.Thread(target=run_session, args=(session,),
+                         name='session ' + session.name, daemon=True).start()
+    session.queue.put((ce, received))
+
+
+def run_session(session):
+    '''Run the commands that command() queues for session, until it ends'''
+
+    while True:
+        (ce, received) = session.queue.get()
+        send_reply(handle_line(ce, received))
+        with sessions_lock:
+            if sessions.get(session.name) is not session:
+                return
+
+
+def send_reply(line):
+    with reply_lock:
+        print(line)
+        sys.stdout.flush()
+
+
+def parse_tags(ce):
+    '''Split the command line ce into (id tag or None, session name, command)'''
+
+    tag = None
+    if ce.startswith('id='):
+        tag, ce = (ce.split(None, 1) + [''])[:2]
+    name = '0'
+    if ce.startswith('session='):
+        name, ce = (ce.split(None, 1) + [''])[:2]
+        name = name[len('session='):]
+    return (tag, name, ce)
+
+
+def handle_line(ce, received=None):
+    '''Run the command line ce, with its tags, and return the reply line
+
+    received is the time.monotonic() when the line was read, for reporting
+    how long it took until the command was dispatched. This can be called
+    from several threads; commands of the same session wait for each other.
+    '''
+    if received is None:
+        received = time.monotonic()
+    (tag, name, ce) = parse_tags(ce)
+    with sessions_lock:
+        session = sessions.get(name)
+    if session is None:
+        bomb("unknown session `%s'" % name)
+    with session.lock:
+        start = time.monotonic()
+        try:
+            reply = dispatch(session, ce)
+        except Exception as e:
+            if session.name == '0':
+                # the server's own session; fail as a server of one testbed
+                raise
+            reply = session_failed(session, e)
+    if tag:
+        reply = tag + ' ' + reply
+    adtlog.debug('%s: dispatched after %.1fms, ran for %.1fms' % (
+        ce.split()[0], (start - received) * 1000, (time.monotonic() - start) * 1000))
+    return reply
+
+
+def session_failed(session, e):
+    '''Clean up session after e, and return the error reply
+
+    This closes the session's testbed, as exiting would have, and resets
+    it as a new session, so that it can be opened again.
+    '''
+    if isinstance(e, Quit):
+        m = e.m
+    else:
+        adtlog.debug(traceback.format_exc())
+        m = 'unexpected error: %s' % ''.join(
+            traceback.format_exception_only(type(e), e)).strip()
+    try:
+        cleanup_session(session)
+    except Exception as ce:
+        m += '\nwhile cleaning up: %s' % getattr(ce, 'm', ce)
+    session.reset()
+    adtlog.debug('session %s failed: %s' % (session.name, m))
+    return 'error ' + url_quote(m)
+
 
 signal_list = [	signal.SIGHUP, signal.SIGTERM,
                 signal.SIGINT, signal.SIGPIPE]
@@ -660,17 +1354,31 @@ def sethandlers(f):
         signal.signal(signum, f)
 
 
+def cleanup_session(session):
+    '''Close the testbed of session'''
+    # avoid recursion if something bomb()s in hook_cleanup()
+    if not session.cleaning:
+        session.cleaning = True
+        try:
+            if session.downtmp:
+                caller.hook_cleanup(session)
+        finally:
+            session.cleaning = False
+            session.downtmp = None
+            session.copy_compression = None
+
+
 def cleanup():
-    global downtmp, cleaning
     adtlog.debug("cleanup...")
-    sethandlers(signal.SIG_DFL)
-    # avoid recursion if something bomb()s in hook_cleanup()
-    if not cleaning:
-        cleaning = True
-        if downtmp:
-            caller.hook_cleanup()
-        cleaning = False
-        downtmp = None
+    if not in_process:
+        sethandlers(signal.SIG_DFL)
+    with sessions_lock:
+        # the first session last, so that its error is the one reported
+        todo = list(sessions.values())[1:] + list(sessions.values())[:1]
+    for session in todo:
+        # after a command that is still running in it
+        with session.lock:
+            cleanup_session(session)
 
 
 def error_cleanup():
@@ -722,6 +1430,40 @@ def mainloop():
 
 
 def main():
+    # servers set up their globals before calling this
+    sessions['0'] = Session('0')
+    if in_process:
+        # the client calls handle_line() itself
+        return
     ok()
     prepare()
     mainloop()
+
+
+def load_in_process(path, args):
+    '''Run the server script at path in this process
+
+    The script sets itself up as usual with args as its command line, but
+    its call of main() returns instead of reading commands from stdin; the
+    client then runs them with handle_line(). Only one server can be loaded
+    into a process, but it can have several sessions.
+    '''
+    global caller, in_process, in_mainloop
+    if in_process:
+        bomb('a server is already loaded in this process')
+    name = 'reprotest_virt_' + os.path.basename(path)
+    loader = importlib.machinery.SourceFileLoader(name, path)
+    module = types.ModuleType(name)
+    module.__file__ = path
+    argv = sys.argv
+    sys.argv = [path] + list(args)
+    # bomb() must raise Quit instead of exiting
+    (caller, in_process, in_mainloop) = (module, True, True)
+    try:
+        loader.exec_module(module)
+    except BaseException:
+        (caller, in_process, in_mainloop) = (__main__, False, False)
+        raise
+    finally:
+        sys.argv = argv
+    return module
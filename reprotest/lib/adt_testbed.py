@@ -22,6 +22,9 @@
 
 import os
 import sys
+import atexit
+import collections
+import itertools
 import errno
 import time
 import pipes
@@ -30,7 +33,9 @@ import re
 import signal
 import subprocess
 import tempfile
+import threading
 import shutil
+import json
 import urllib.parse
 
 
@@ -42,15 +47,274 @@ import urllib.parse
 
 from reprotest.lib import adtlog
 from reprotest.lib import VirtSubproc
+from reprotest.lib import testbed_agent
 
 
 timeouts = {'short': 100, 'copy': 300, 'install': 3000, 'test': 10000,
             'build': 100000}
+# kinds of commands that Testbed.execute() runs through the agent, if any
+agent_kinds = ('short', 'copy')
+
+
+class AgentCommand:
+    '''A command running in a TestbedAgent'''
+
+    def __init__(self, stdout, stderr):
+        # where its output goes: a file descriptor, or a list to collect it
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+        self.done = threading.Event()
+
+
+class InProcessServer:
+    '''A virt server script running in this process
+
+    Commands are handed to VirtSubproc directly, instead of to a separate
+    python process through pipes. VirtSubproc keeps the server's state in
+    module globals, so there can only be one of these per process; each
+    Testbed that uses it gets a session of its own, whose commands run at
+    the same time as those of the others. Deadlines in the server don't
+    interrupt our main thread with SIGALRM; they only stop its commands.
+    '''
+
+    def __init__(self, argv):
+        self.argv = list(argv)
+        try:
+            VirtSubproc.load_in_process(self.argv[0], self.argv[1:])
+        except (VirtSubproc.Quit, SystemExit) as e:
+            raise OSError('cannot load %s: %s' % (self.argv[0], getattr(e, 'm', e)))
+        atexit.register(self.cleanup)
+
+    def handle(self, line):
+        try:
+            return VirtSubproc.handle_line(line)
+        except VirtSubproc.Quit as q:
+            raise adtlog.TestbedFailure(q.m)
+        except Exception:
+            # a separate server would exit on this
+            adtlog.debug(traceback.format_exc())
+            raise adtlog.TestbedFailure('unexpected error in the testbed: %s' % ''.join(
+                traceback.format_exception_only(*sys.exc_info()[:2])).strip())
+
+    def cleanup(self):
+        '''Close any sessions that are still open, as a server would at EOF'''
+        VirtSubproc.cleanup()
+
+
+in_process_server = None  # the InProcessServer, False if it failed to load
+
+
+def get_in_process_server(argv):
+    global in_process_server
+
+    if in_process_server is None:
+        try:
+            in_process_server = InProcessServer(argv)
+        except OSError:
+            in_process_server = False
+            raise
+    if not in_process_server:
+        raise OSError('loading a virt server in this process failed before')
+    if in_process_server.argv != list(argv):
+        raise OSError('another virt server is loaded in this process already')
+    return in_process_server
+
+
+class SharedServer:
+    '''The pipes to a virt server process whose sessions several Testbeds use
+
+    The server runs the commands of different sessions at the same time, so
+    their replies can come in any order. Each command is tagged with an id,
+    and whoever waits for a reply reads the replies for everyone until its
+    own one arrives.
+    '''
+
+    def __init__(self, sp):
+        self.sp = sp
+        self.write_lock = threading.Lock()
+        self.cond = threading.Condition()  # guards the attributes below
+        self.replies = {}  # id -> reply line, not picked up yet
+        self.reading = False
+        self.eof = False
+        self.ids = itertools.count(1)
+
+    def send(self, line):
+        '''Send the command line, and return the id to wait for its reply'''
+        id = 's%i' % next(self.ids)
+        with self.write_lock:
+            self.sp.stdin.write('id=%s %s\n' % (id, line))
+            self.sp.stdin.flush()
+        return id
+
+    def reply(self, id):
+        '''Return the reply line to command id, without the tag
+
+        This is '' at EOF. A line without a known id is returned to
+        whoever reads it.
+        '''
+        with self.cond:
+            while id not in self.replies and not self.eof and self.reading:
+                self.cond.wait()
+            if id in self.replies:
+                return self.replies.pop(id)
+            if self.eof:
+                return ''
+            self.reading = True
+        try:
+            while True:
+                l = self.sp.stdout.readline()
+                (tag, rest) = (l.split(None, 1) + [''])[:2]
+                with self.cond:
+                    if not l:
+                        self.eof = True
+                        return ''
+                    if tag == 'id=' + id:
+                        return rest
+                    if not tag.startswith('id=s'):
+                        return l
+                    self.replies[tag[3:]] = rest
+                    self.cond.notify_all()
+        finally:
+            with self.cond:
+                self.reading = False
+                self.cond.notify_all()
+
+
+class TestbedAgent:
+    '''A testbed_agent.py running in the testbed
+
+    It is started once through the auxverb, and then runs any number of
+    commands, possibly at the same time, without starting a new auxverb
+    process for each of them.
+    '''
+
+    def __init__(self, exec_cmd, start_timeout=30):
+        with open(testbed_agent.__file__, 'rb') as f:
+            source = f.read()
+        self.proc = subprocess.Popen(
+            exec_cmd + ['python3', '-c', 'import sys; exec(sys.stdin.buffer.read(%i))' % len(source)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, start_new_session=True)
+        self.proc.stdin.write(source)
+        self.proc.stdin.flush()
+        self.lock = threading.Lock()  # for writing frames
+        # guards commands and alive, so that no command is added after the
+        # reader gave up on the agent
+        self.commands_lock = threading.Lock()
+        self.commands = {}
+        self.last_id = 0
+        self.alive = True
+        # set once the agent said hello, or went away without doing so
+        self.hello = threading.Event()
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+        try:
+            started = self.hello.wait(start_timeout) and self.alive
+        except BaseException:
+            # in a session of its own, so an interrupt didn't reach it
+            killtree(self.proc.pid)
+            self.close()
+            raise
+        if not started:
+            self.close()
+            raise OSError('testbed agent did not start')
+
+    def _read(self):
+        while True:
+            frame = testbed_agent.read_frame(self.proc.stdout)
+            if frame is None:
+                break
+            (kind, id, payload) = frame
+            if kind == testbed_agent.HELLO:
+                self.hello.set()
+                continue
+            with self.commands_lock:
+                command = self.commands.get(id)
+            if command is None:
+                continue
+            if kind in (testbed_agent.STDOUT, testbed_agent.STDERR):
+                target = command.stdout if kind == testbed_agent.STDOUT else command.stderr
+                if isinstance(target, list):
+                    target.append(payload)
+                else:
+                    while payload:
+                        payload = payload[os.write(target, payload):]
+            elif kind == testbed_agent.EXIT:
+                command.returncode = int(payload)
+                with self.commands_lock:
+                    del self.commands[id]
+                command.done.set()
+        # the agent went away, so its commands won't finish
+        with self.commands_lock:
+            self.alive = False
+            commands = list(self.commands.values())
+            self.commands.clear()
+        for command in commands:
+            command.returncode = 255
+            command.done.set()
+        self.hello.set()
+
+    def _send(self, kind, id, payload=b''):
+        testbed_agent.write_frame(self.proc.stdin, self.lock, kind, id, payload)
+
+    def start(self, argv, env, stdout, stderr):
+        '''Start running argv with the extra environment env
+
+        stdout and stderr are file descriptors, or lists to collect the
+        output in. Return the id of the command.
+        '''
+        command = AgentCommand(stdout, stderr)
+        with self.commands_lock:
+            self.last_id += 1
+            id = self.last_id
+            alive = self.alive
+            if alive:
+                self.commands[id] = command
+        if not alive:
+            command.returncode = 255
+            command.done.set()
+            return id, command
+        try:
+            self._send(testbed_agent.RUN, id, json.dumps(
+                {'argv': argv, 'env': env}).encode('UTF-8'))
+        except OSError:
+            command.returncode = 255
+            command.done.set()
+        return id, command
+
+    def kill(self, id):
+        try:
+            self._send(testbed_agent.KILL, id)
+        except OSError:
+            pass
+
+    def cancel(self):
+        '''Kill all running commands'''
+        with self.commands_lock:
+            ids = list(self.commands)
+        for id in ids:
+            adtlog.debug('cancelling testbed agent command %i' % id)
+            self.kill(id)
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.proc.wait(timeout=10)
+        except BaseException as e:
+            killtree(self.proc.pid)
+            self.proc.wait()
+            if not isinstance(e, subprocess.TimeoutExpired):
+                raise
+        self.reader.join()
 
 
 class Testbed:
     def __init__(self, vserver_argv, output_dir, user,
-                 setup_commands=[], add_apt_pockets=[], copy_files=[]):
+                 setup_commands=[], add_apt_pockets=[], copy_files=[],
+                 use_agent=False, in_process=False):
         self.sp = None
         self.lastsend = None
         self.scratch = None
@@ -78,6 +342,25 @@ class Testbed:
         self.nproc = None
         self.cpu_model = None
         self.cpu_flags = None
+        # commands may be sent from several threads, but the protocol is
+        # strictly one request and one reply at a time, unless shared
+        self._command_lock = threading.Lock()
+        # processes started by execute() which have not finished yet
+        self._running = set()
+        self._running_lock = threading.Lock()
+        # set by cancel() until uncancel(); commands started meanwhile are
+        # killed straight away
+        self._cancelled = False
+        # run short commands through a TestbedAgent, if it starts
+        self.use_agent = use_agent
+        self.agent = None
+        # our session of a server that we share, see new_session()
+        self.session = None
+        self.shared = None  # SharedServer, once sessions share self.sp
+        # try to run the server in this process, see InProcessServer
+        self.in_process = in_process
+        self.server = None
+        self.replies = collections.deque()  # from self.server, not read yet
 
         try:
             self.devnull = subprocess.DEVNULL
@@ -104,6 +387,17 @@ class Testbed:
         adtlog.info('host %s; command line: %s' % (
             os.uname()[1], ' '.join([pipes.quote(w) for w in sys.argv])))
 
+        if self.in_process:
+            try:
+                server = get_in_process_server(self.vserver_argv)
+            except OSError as e:
+                adtlog.debug('not running the virt server in this process: %s' % e)
+            else:
+                self.server = server
+                self.session = self.command('new-session', (), 1)[0]
+                adtlog.debug('virt server runs in this process, session %s' % self.session)
+                return
+
         self.sp = subprocess.Popen(self.vserver_argv,
                                    stdin=subprocess.PIPE,
                                    stdout=subprocess.PIPE,
@@ -118,8 +412,19 @@ class Testbed:
         self.stop_sent = True
 
         self.close()
+        if self.server:
+            # others may still use it
+            self.command('end-session')
+            self.server = None
+            return
         if self.sp is None:
             return
+        if self.session is not None:
+            # the server is not ours to quit
+            if self.sp.returncode is None:
+                self.command('end-session')
+            self.sp = None
+            return
         ec = self.sp.returncode
         if ec is None:
             self.sp.stdout.close()
@@ -130,6 +435,29 @@ class Testbed:
             self.bomb('testbed gave exit status %d after quit' % ec)
         self.sp = None
 
+    def new_session(self, output_dir):
+        '''Return a Testbed for a new session of our virt server
+
+        The virt server must have the 'sessions' capability. The new testbed
+        shares the server process with this one, instead of starting another
+        one; it is not open yet, and must be stopped before this one.
+        '''
+        with self._command_lock:
+            if self.sp and not self.shared:
+                # from now on, the sessions send their commands at the same
+                # time
+                self.shared = SharedServer(self.sp)
+        name = self.command('new-session', (), 1)[0]
+        testbed = Testbed(self.vserver_argv, output_dir, self.user,
+                          self.setup_commands, self.add_apt_pockets,
+                          self.copy_files, self.use_agent)
+        testbed.sp = self.sp
+        testbed.shared = self.shared
+        testbed.server = self.server
+        testbed.session = name
+        adtlog.debug('testbed session %s started' % name)
+        return testbed
+
     def open(self):
         adtlog.debug('testbed open, scratch=%s' % self.scratch)
         if self.scratch is not None:
@@ -197,6 +525,7 @@ class Testbed:
         self.apt_pin_for_pockets = []
         self.recommends_installed = False
         self.exec_cmd = list(map(urllib.parse.unquote, self.command('print-execute-command', (), 1)[0].split(',')))
+        self.start_agent()
         self.caps = self.command('capabilities', (), None)
         adtlog.debug('testbed capabilities: %s' % self.caps)
         for c in self.caps:
@@ -230,20 +559,54 @@ class Testbed:
 
         self.post_boot_setup()
 
+    def start_agent(self):
+        self.stop_agent()
+        if not self.use_agent:
+            return
+        try:
+            self.agent = TestbedAgent(self.exec_cmd)
+            adtlog.debug('testbed agent started')
+        except OSError as e:
+            adtlog.warning('cannot start testbed agent, running commands '
+                           'without it: %s' % e)
+
+    def stop_agent(self):
+        if self.agent:
+            self.agent.close()
+            self.agent = None
+
     def close(self):
         adtlog.debug('testbed close, scratch=%s' % self.scratch)
         if self.scratch is None:
             return
         self.scratch = None
-        if self.sp is None:
+        self.stop_agent()
+        if self.sp is None and self.server is None:
             return
         self.command('close')
         self.shared_downtmp = None
 
+    def recycle(self):
+        '''Get back a clean testbed, e.g. to reuse it for another build.
+
+        This reverts the testbed if the server supports that, and otherwise
+        closes and reopens it, which at least gives a fresh scratch dir.'''
+        adtlog.debug('testbed recycle, scratch=%s' % self.scratch)
+        if 'revert' in self.caps:
+            self.stop_agent()
+            pl = self.command('revert', (), 1)
+            self._opened(pl)
+        else:
+            self.close()
+            self.open()
+        self.modified = False
+
     def reboot(self, prepare_only=False):
         '''Reboot the testbed'''
 
+        self.stop_agent()
         self.command('reboot', prepare_only and ('prepare-only', ) or ())
+        self.start_agent()
         self.post_boot_setup()
 
     def run_setup_commands(self):
@@ -308,6 +671,7 @@ class Testbed:
                 self.modified or self.recommends_installed != with_recommends or
                 [d for d in self.deps_installed if d not in deps_new]):
             adtlog.debug('testbed reset')
+            self.stop_agent()
             pl = self.command('revert', (), 1)
             self._opened(pl)
         self.modified = False
@@ -338,6 +702,11 @@ class Testbed:
         self.bomb(m, adtlog.BadPackageError)
 
     def send(self, string):
+        if self.server:
+            adtlog.debug('sending command to testbed: ' + string)
+            self.lastsend = string
+            self.replies.append(self.server.handle(string))
+            return
         try:
             adtlog.debug('sending command to testbed: ' + string)
             self.sp.stdin.write(string)
@@ -350,7 +719,17 @@ class Testbed:
                       format_exception_only(type, value))
 
     def expect(self, keyword, nresults):
-        l = self.sp.stdout.readline()
+        (l, ll) = self._readline()
+        return self._check_reply(l, ll, keyword, nresults)
+
+    def _readline(self):
+        if self.server:
+            l = self.replies and self.replies.popleft() + '\n' or ''
+        else:
+            l = self.sp.stdout.readline()
+        return self._parse_reply(l)
+
+    def _parse_reply(self, l):
         if not l:
             self.bomb('unexpected eof from the testbed')
         if not l.endswith('\n'):
@@ -360,6 +739,16 @@ class Testbed:
         ll = l.split()
         if not ll:
             self.bomb('unexpected whitespace-only line from the testbed')
+        return (l, ll)
+
+    def _check_reply(self, l, ll, keyword, nresults):
+        if ll[0] == 'error' and keyword != 'error':
+            # the server closed our session's testbed, but carries on
+            self.scratch = None
+            self.shared_downtmp = None
+            self.stop_agent()
+            self.bomb("sent `%s', got error: %s" %
+                      (self.lastsend, urllib.parse.unquote(' '.join(ll[1:]))))
         if ll[0] != keyword:
             if self.lastsend is None:
                 self.bomb("got banner `%s', expected `%s...'" %
@@ -374,7 +763,7 @@ class Testbed:
                       (self.lastsend, l, len(ll), nresults))
         return ll
 
-    def command(self, cmd, args=(), nresults=0, unquote=True):
+    def _command_line(self, cmd, args):
         # pass args=[None,...] or =(None,...) to avoid more url quoting
         if type(cmd) is str:
             cmd = [cmd]
@@ -382,13 +771,84 @@ class Testbed:
             args = args[1:]
         else:
             args = list(map(urllib.parse.quote, args))
-        al = cmd + args
-        self.send(' '.join(al))
-        ll = self.expect('ok', nresults)
+        if self.session is not None:
+            cmd = ['session=' + self.session] + cmd
+        return ' '.join(cmd + args)
+
+    def _send_shared(self, line):
+        '''Send line through self.shared, and return its id'''
+        adtlog.debug('sending command to testbed: ' + line)
+        self.lastsend = line
+        try:
+            return self.shared.send(line)
+        except OSError as e:
+            self.bomb('cannot send to testbed: %s' % e)
+
+    def command(self, cmd, args=(), nresults=0, unquote=True):
+        if self.shared:
+            id = self._send_shared(self._command_line(cmd, args))
+            (l, ll) = self._parse_reply(self.shared.reply(id))
+            ll = self._check_reply(l, ll, 'ok', nresults)
+        else:
+            with self._command_lock:
+                self.send(self._command_line(cmd, args))
+                ll = self.expect('ok', nresults)
         if unquote:
             ll = list(map(urllib.parse.unquote, ll))
         return ll
 
+    def command_batch(self, commands, unquote=True):
+        '''Run several commands, given as (cmd, args, nresults) tuples.
+
+        Return the list of their results. If the testbed supports it, all
+        commands are sent at once and the replies are matched to them by
+        their id, instead of waiting for each reply before sending the next
+        command.
+        '''
+        if 'batch' not in getattr(self, 'caps', ()):
+            return [self.command(cmd, args, nresults, unquote)
+                    for (cmd, args, nresults) in commands]
+        lines = [self._command_line(cmd, args) for (cmd, args, _) in commands]
+        if self.shared:
+            ids = [self._send_shared(line) for line in lines]
+            # read all replies before checking any, so that they don't pile
+            # up in self.shared
+            replies = [self._parse_reply(self.shared.reply(id)) for id in ids]
+        else:
+            replies = self._batch_replies(lines)
+        results = []
+        for (i, (l, ll)) in enumerate(replies):
+            self.lastsend = lines[i]
+            results.append(self._check_reply(l, ll, 'ok', commands[i][2]))
+        if unquote:
+            results = [list(map(urllib.parse.unquote, ll)) for ll in results]
+        return results
+
+    def _batch_replies(self, lines):
+        '''Send lines at once, and return the (line, words) of their replies'''
+        replies = [None] * len(lines)
+        with self._command_lock:
+            for (i, line) in enumerate(lines):
+                self.send('id=%i %s' % (i, line))
+            # read all replies before checking any, so that a failed command
+            # doesn't leave the replies of the others in the pipe
+            unmatched = []
+            for _ in lines:
+                (l, ll) = self._readline()
+                try:
+                    i = int(ll[0][3:]) if ll[0].startswith('id=') else None
+                except ValueError:
+                    i = None
+                if i is None or not 0 <= i < len(lines) or replies[i] is not None \
+                        or len(ll) < 2:
+                    unmatched.append(l)
+                else:
+                    replies[i] = (l, ll[1:])
+        if unmatched:
+            self.bomb("sent `%s', got `%s', expected a reply to one of them" %
+                      ('; '.join(lines), unmatched[0]))
+        return replies
+
     # TODO: with stdout and stderr defaulting to None, this function
     # eats all errors/output from its call, which is not the right
     # thing.
@@ -413,21 +873,28 @@ class Testbed:
                      (argv, kind, stdout and 'pipe' or 'raw',
                       stderr and 'pipe' or 'raw', env))
 
+        if self.agent and self.agent.alive and kind in agent_kinds:
+            return self._execute_agent(argv, env, stdout, stderr, kind)
+
         if env:
             argv = ['env'] + env + argv
 
-        # import pdb; pdb.set_trace()
-        VirtSubproc.timeout_start(timeouts[kind])
+        # in a session of its own, so that killtree() is cheap; signals for
+        # our process group don't reach it, so it is killed whenever we
+        # don't wait for it to finish
+        proc = subprocess.Popen(self.exec_cmd + argv,
+                                stdin=self.devnull,
+                                stdout=stdout, stderr=stderr,
+                                start_new_session=True)
+        with self._running_lock:
+            self._running.add(proc)
+            cancelled = self._cancelled
         try:
-            proc = subprocess.Popen(self.exec_cmd + argv,
-                                    stdin=self.devnull,
-                                    stdout=stdout, stderr=stderr)
-            (out, err) = proc.communicate()
-            if out is not None:
-                out = out.decode()
-            if err is not None:
-                err = err.decode()
-            VirtSubproc.timeout_stop()
+            if cancelled:
+                killtree(proc.pid)
+            # this works in any thread, so builds can run concurrently
+            with VirtSubproc.timeout(timeouts[kind], kill=lambda: killtree(proc.pid)):
+                (out, err) = proc.communicate()
         except VirtSubproc.Timeout:
             # This is a bit of a hack, but what can we do.. we can't kill/clean
             # up sudo processes, we can only hope that they clean up themselves
@@ -439,9 +906,19 @@ class Testbed:
             msg = 'timed out on command "%s" (kind: %s)' % (' '.join(argv), kind)
             if kind == 'test':
                 adtlog.error(msg)
-                raise
+                raise VirtSubproc.Timeout()
             else:
                 self.bomb(msg)
+        except BaseException:
+            killtree(proc.pid)
+            raise
+        finally:
+            with self._running_lock:
+                self._running.discard(proc)
+        if out is not None:
+            out = out.decode()
+        if err is not None:
+            err = err.decode()
 
         adtlog.debug('testbed command exited with code %i' % proc.returncode)
 
@@ -455,6 +932,67 @@ class Testbed:
 
         return (proc.returncode, out, err)
 
+    def _execute_agent(self, argv, env, stdout, stderr, kind):
+        '''Like execute(), but through the agent'''
+
+        def target(f, default):
+            if f is None:
+                return default
+            if f == subprocess.PIPE:
+                return []
+            if isinstance(f, int):
+                return f
+            return f.fileno()
+
+        out = target(stdout, sys.stdout.fileno())
+        err = out if stderr == subprocess.STDOUT else target(stderr, sys.stderr.fileno())
+        agent = self.agent
+        (id, command) = agent.start(argv, env, out, err)
+        with self._running_lock:
+            cancelled = self._cancelled
+        if cancelled:
+            agent.kill(id)
+        try:
+            with VirtSubproc.timeout(timeouts[kind], kill=lambda: agent.kill(id)):
+                command.done.wait()
+        except VirtSubproc.Timeout:
+            agent.kill(id)
+            command.done.wait(10)
+            adtlog.debug('timed out on testbed agent command %s (kind: %s)' % (argv, kind))
+            self.bomb('timed out on command "%s" (kind: %s)' % (' '.join(argv), kind))
+        except BaseException:
+            agent.kill(id)
+            raise
+        adtlog.debug('testbed command exited with code %i' % command.returncode)
+
+        out = b''.join(out).decode() if isinstance(out, list) else None
+        err = b''.join(err).decode() if isinstance(err, list) and err is not out else None
+        if command.returncode == 255 and not agent.alive:
+            self.bomb('testbed agent failed')
+        return (command.returncode, out, err)
+
+    def cancel(self):
+        '''Kill all commands that are currently running through execute()
+
+        This is used to abort a build as soon as a concurrent one has failed.
+        The interrupted execute() calls return the killed command's exit
+        status as usual. Commands that are started after this are killed
+        as soon as they are running, until uncancel() is called.
+        '''
+        with self._running_lock:
+            self._cancelled = True
+            running = list(self._running)
+        for proc in running:
+            adtlog.debug('cancelling testbed command %s' % proc.args)
+            killtree(proc.pid)
+        if self.agent:
+            self.agent.cancel()
+
+    def uncancel(self):
+        '''Let commands run again after cancel()'''
+        with self._running_lock:
+            self._cancelled = False
+
     def check_exec(self, argv, stdout=False, kind='short', xenv=[]):
         '''Run argv in testbed.
 
@@ -1288,12 +1826,78 @@ def child_ps(pid):
         return []
 
 
+def proc_children():
+    '''Map pids to the pids of their children, with one scan of /proc'''
+
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name, 'rb') as f:
+                stat = f.read()
+        except OSError:
+            # it exited meanwhile
+            continue
+        # the command name in parentheses may contain anything
+        ppid = int(stat.rsplit(b')', 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(name))
+    return children
+
+
+def descendants(pid):
+    '''Get all processes below pid'''
+
+    try:
+        children = proc_children().get
+    except OSError:
+        # no /proc
+        children = lambda p, default: child_ps(p)
+    result = []
+    todo = [pid]
+    while todo:
+        for child in children(todo.pop(), []):
+            result.append(child)
+            todo.append(child)
+    return result
+
+
+def left_group(pid, pgid):
+    '''Whether pid is still running, but not in process group pgid'''
+    try:
+        return os.getpgid(pid) != pgid
+    except OSError:
+        return False
+
+
 def killtree(pid):
-    '''Recursively kill pid and all of its children'''
+    '''Kill pid and all of its children
 
-    for child in child_ps(pid):
-        killtree(child)
+    Commands started by Testbed.execute() lead their own session, so one
+    killpg() gets most of the tree. Processes that moved to a session of
+    their own are found beforehand, while they can still be told apart
+    from other orphans.
+    '''
+    start = time.time()
+    pids = [pid] + descendants(pid)
     try:
-        os.kill(pid, signal.SIGTERM)
+        group = os.getpgid(pid) == pid
     except OSError:
-        pass
+        group = False
+    if group:
+        # the rest are killed with the group
+        pids = [p for p in pids if left_group(p, pid)]
+        try:
+            os.killpg(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    for p in pids:
+        try:
+            os.kill(p, signal.SIGTERM)
+        except OSError:
+            pass
+    if group:
+        what = 'process group %i and %i processes that left it' % (pid, len(pids))
+    else:
+        what = '%i processes below %i' % (len(pids), pid)
+    adtlog.debug('killed %s in %.1fms' % (what, (time.time() - start) * 1000))
@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+'''Runs commands inside a testbed on behalf of adt_testbed.TestbedAgent.
+
+The agent is started once through the testbed's auxverb, which feeds it this
+file on stdin; afterwards, stdin and stdout carry frames of a header (kind,
+command id, length) and a payload. The host sends RUN, with the argv and
+extra environment of a command as JSON, and KILL; the agent answers with
+HELLO once, then STDOUT and STDERR with the output of each command, and EXIT
+with its exit status.
+
+This must only use the standard library of any python3, as it runs in the
+testbed.
+'''
+
+import json
+import os
+import signal
+import struct
+import subprocess
+import sys
+import threading
+
+HEADER = struct.Struct('>cII')
+HELLO = b'H'
+RUN = b'R'
+KILL = b'K'
+STDOUT = b'O'
+STDERR = b'E'
+EXIT = b'X'
+
+
+def read_exactly(f, n):
+    '''Read n bytes from f, or return None at EOF'''
+    data = b''
+    while len(data) < n:
+        block = f.read(n - len(data))
+        if not block:
+            return None
+        data += block
+    return data
+
+
+def read_frame(f):
+    '''Return the next (kind, id, payload) from f, or None at EOF'''
+    header = read_exactly(f, HEADER.size)
+    if header is None:
+        return None
+    (kind, id, length) = HEADER.unpack(header)
+    payload = read_exactly(f, length)
+    if payload is None:
+        return None
+    return (kind, id, payload)
+
+
+def write_frame(f, lock, kind, id, payload=b''):
+    with lock:
+        f.write(HEADER.pack(kind, id, len(payload)) + payload)
+        f.flush()
+
+
+class Agent:
+
+    def __init__(self, fin, fout):
+        self.fin = fin
+        self.fout = fout
+        self.lock = threading.Lock()
+        self.procs = {}
+
+    def send(self, kind, id, payload=b''):
+        write_frame(self.fout, self.lock, kind, id, payload)
+
+    def run(self, id, request):
+        env = dict(os.environ)
+        env.update(e.split('=', 1) for e in request['env'])
+        try:
+            # in its own process group, so that KILL gets its children too
+            proc = subprocess.Popen(request['argv'], env=env,
+                                    stdin=subprocess.DEVNULL,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE,
+                                    preexec_fn=os.setsid)
+        except OSError as e:
+            # like env(1) would
+            self.send(STDERR, id, ('%s: %s\n' % (request['argv'][0], e.strerror)).encode())
+            self.send(EXIT, id, b'127')
+            return
+        self.procs[id] = proc
+        pumps = [threading.Thread(target=self.pump, args=(proc.stdout, STDOUT, id)),
+                 threading.Thread(target=self.pump, args=(proc.stderr, STDERR, id))]
+        for t in pumps:
+            t.start()
+        threading.Thread(target=self.wait, args=(id, proc, pumps)).start()
+
+    def pump(self, f, kind, id):
+        for block in iter(lambda: os.read(f.fileno(), 65536), b''):
+            self.send(kind, id, block)
+        f.close()
+
+    def wait(self, id, proc, pumps):
+        for t in pumps:
+            t.join()
+        rc = proc.wait()
+        del self.procs[id]
+        # like a shell does for commands killed by a signal
+        self.send(EXIT, id, str(rc if rc >= 0 else 128 - rc).encode())
+
+    def kill(self, id):
+        proc = self.procs.get(id)
+        if proc is not None:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def serve(self):
+        self.send(HELLO, 0)
+        while True:
+            frame = read_frame(self.fin)
+            if frame is None:
+                break
+            (kind, id, payload) = frame
+            if kind == RUN:
+                self.run(id, json.loads(payload.decode('UTF-8')))
+            elif kind == KILL:
+                self.kill(id)
+        # the host went away; don't leave anything behind
+        for id in list(self.procs):
+            self.kill(id)
+
+
+if __name__ == '__main__':
+    Agent(sys.stdin.buffer, sys.stdout.buffer).serve()
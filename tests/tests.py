@@ -2,8 +2,12 @@
 # For details: reprotest/debian/copyright
 
 import os
+import shutil
+import signal
 import subprocess
 import sys
+import threading
+import time
 
 import pytest
 import reprotest
@@ -17,9 +21,9 @@ if REPROTEST_TEST_DONTVARY:
 
 TEST_VARIATIONS = frozenset(reprotest.VARIATIONS.keys()) - frozenset(REPROTEST_TEST_DONTVARY)
 
-def check_return_code(command, virtual_server, code):
+def check_return_code(command, virtual_server, code, **kwargs):
     try:
-        retcode = reprotest.check(command, 'artifact', virtual_server, 'tests', variations=TEST_VARIATIONS)
+        retcode = reprotest.check(command, 'artifact', virtual_server, 'tests', variations=TEST_VARIATIONS, **kwargs)
     except SystemExit as system_exit:
         retcode = system_exit.args[0]
     finally:
@@ -44,6 +48,412 @@ def test_simple_builds(virtual_server):
     check_return_code('python3 mock_failure.py', virtual_server, 2)
     check_return_code('python3 mock_build.py irreproducible', virtual_server, 1)
 
+def test_concurrent_builds(virtual_server):
+    check_return_code('python3 mock_build.py', virtual_server, 0, concurrent_builds=True)
+    check_return_code('python3 mock_failure.py', virtual_server, 2, concurrent_builds=True)
+    check_return_code('python3 mock_build.py irreproducible', virtual_server, 1, concurrent_builds=True)
+
+def test_separate_testbeds(virtual_server):
+    check_return_code('python3 mock_build.py', virtual_server, 0, separate_testbeds=True)
+    check_return_code('python3 mock_failure.py', virtual_server, 2, separate_testbeds=True)
+    check_return_code('python3 mock_build.py irreproducible', virtual_server, 1,
+                      separate_testbeds=True, concurrent_builds=True)
+
+def test_control_cache(virtual_server, tmpdir, monkeypatch):
+    control_cache = reprotest._cache.ControlCache(str(tmpdir.join('cache')), 1 << 20)
+    check_return_code('python3 mock_build.py', virtual_server, 0, control_cache=control_cache)
+    assert(len(tmpdir.join('cache').listdir('[!.]*')) == 1)
+    # the control build now comes from the cache, even from another shell
+    monkeypatch.setenv('SHLVL', '42')
+    check_return_code('python3 mock_build.py', virtual_server, 0, control_cache=control_cache)
+    assert(len(tmpdir.join('cache').listdir('[!.]*')) == 1)
+    check_return_code('python3 mock_build.py irreproducible', virtual_server, 1, control_cache=control_cache)
+    assert(len(tmpdir.join('cache').listdir('[!.]*')) == 2)
+
+def test_sync_dir(virtual_server, tmpdir):
+    sync_dir = str(tmpdir.join('sync'))
+    check_return_code('python3 mock_build.py', virtual_server, 0, sync_dir=sync_dir)
+    # the second run syncs into the mirror left by the first one
+    check_return_code('python3 mock_build.py irreproducible', virtual_server, 1, sync_dir=sync_dir)
+    assert(len(tmpdir.join('sync').listdir()) == 1)
+
+def test_testbed_agent(virtual_server):
+    check_return_code('python3 mock_build.py', virtual_server, 0, testbed_agent=True)
+    check_return_code('python3 mock_build.py irreproducible', virtual_server, 1, testbed_agent=True)
+
+def test_testbed_agent_dead():
+    from reprotest.lib import adt_testbed
+    # no python3 to run the agent with
+    start = time.time()
+    with pytest.raises(OSError):
+        adt_testbed.TestbedAgent(['env', 'PATH=/nonexistent'])
+    assert(time.time() - start < 10)
+    agent = adt_testbed.TestbedAgent(['env'])
+    agent.proc.kill()
+    agent.reader.join()
+    # commands started after the agent went away don't wait for it
+    (_, command) = agent.start(['true'], [], [], [])
+    assert(command.done.is_set() and command.returncode == 255)
+    agent.close()
+
+def test_treehash(tmpdir):
+    tree = tmpdir.join('tree').mkdir()
+    tree.join('a').write('a')
+    tree.join('d').mkdir().join('b').write('b')
+    index = str(tmpdir.join('index'))
+    digest = reprotest._treehash.TreeHasher().digest(reprotest._treehash.TreeScan(str(tree)))
+    os.utime(str(tree.join('d', 'b')), (0, 0))
+    hasher = reprotest._treehash.TreeHasher(index)
+    assert(hasher.digest(reprotest._treehash.TreeScan(str(tree))) == digest)
+    hasher.save()
+    # only files that weren't just modified are remembered
+    assert(list(reprotest._treehash.TreeHasher(index).index.values()) ==
+           [reprotest._treehash.hash_file(str(tree.join('d', 'b')))])
+    tree.join('d', 'b').write('c')
+    assert(reprotest._treehash.TreeHasher(index).digest(
+        reprotest._treehash.TreeScan(str(tree))) != digest)
+
+def test_compare(tmpdir):
+    for d in ('a', 'b'):
+        tmpdir.join(d).mkdir().join('same').write('same')
+        tmpdir.join(d).join('sub').mkdir().join('differs').write(d)
+    for d in ('a', 'b'):
+        for path in ('same', 'sub/differs', 'sub'):
+            tmpdir.join(d, path).setmtime(0)
+    a, b = str(tmpdir.join('a')), str(tmpdir.join('b'))
+    assert(reprotest._compare.differing_files(a, b) == ['sub/differs'])
+    # directory mtimes don't count, those of files do
+    tmpdir.join('b', 'sub').setmtime(1)
+    assert(reprotest._compare.differing_files(a, b) == ['sub/differs'])
+    tmpdir.join('b', 'same').setmtime(1)
+    assert(reprotest._compare.differing_files(a, b) is None)
+    tmpdir.join('b', 'same').setmtime(0)
+    tmpdir.join('b', 'same').chmod(0o600)
+    assert(reprotest._compare.differing_files(a, b) is None)
+
+def test_copytree(tmpdir):
+    from reprotest.lib import VirtSubproc
+    src = tmpdir.join('src').mkdir()
+    src.join('file').write('new')
+    src.join('d').mkdir().join('f').write('f')
+    src.join('overdir').write('x')
+    outside = tmpdir.join('outside').mkdir()
+    dst = tmpdir.join('dst').mkdir()
+    dst.join('file').mksymlinkto(outside.join('file'))
+    dst.join('d').mksymlinkto(outside)
+    dst.join('overdir').mkdir()
+    with pytest.raises(shutil.Error) as e:
+        VirtSubproc.copytree(str(src), str(dst))
+    # symlinks in dst are not followed
+    assert(outside.listdir() == [])
+    assert(not dst.join('file').islink() and dst.join('file').read() == 'new')
+    failed = sorted(os.path.basename(d) for s, d, why in e.value.args[0])
+    assert(failed == ['d', 'overdir'])
+
+def test_wait_ready():
+    from reprotest.lib import VirtSubproc
+    attempts = []
+    probe = lambda: attempts.append(1) or len(attempts) >= 3 and 'ready'
+    assert(VirtSubproc.wait_ready(probe, 'test', 10, initial_delay=0.01) == 'ready')
+    assert(len(attempts) == 3 and 'test' in VirtSubproc.ready_times)
+    with pytest.raises(VirtSubproc.Timeout):
+        VirtSubproc.wait_ready(lambda: False, 'test', 0.05, initial_delay=0.01)
+
+def test_deadlines():
+    from reprotest.lib import VirtSubproc
+    results = {}
+    def run(name, secs, argv):
+        try:
+            # the outer timeout also applies to the command inside it
+            with VirtSubproc.timeout(secs):
+                results[name] = VirtSubproc.execute_timeout(None, 0, argv)[0]
+        except VirtSubproc.Timeout:
+            results[name] = 'timeout'
+    start = time.time()
+    threads = [threading.Thread(target=run, args=('slow', 0.5, ['sleep', '60'])),
+               threading.Thread(target=run, args=('fast', 30, ['sleep', '1']))]
+    for t in threads:
+        t.start()
+    run('main', 0.5, ['sleep', '60'])
+    for t in threads:
+        t.join()
+    assert(results == {'slow': 'timeout', 'fast': 0, 'main': 'timeout'})
+    assert(time.time() - start < 10)
+
+def test_killtree(monkeypatch):
+    from reprotest.lib import adt_testbed
+    proc = subprocess.Popen(['sh', '-c', 'sleep 60 & setsid sleep 60 & echo; wait'],
+                            stdout=subprocess.PIPE, start_new_session=True)
+    proc.stdout.readline()
+    pids = adt_testbed.descendants(proc.pid)
+    assert(len(pids) == 2)
+    for _ in range(50):
+        # setsid may not have run yet
+        left = [pid for pid in pids if os.getpgid(pid) != proc.pid]
+        if left:
+            break
+        time.sleep(0.1)
+    killed = []
+    kill = os.kill
+    monkeypatch.setattr(os, 'kill', lambda pid, sig: killed.append(pid) or kill(pid, sig))
+    adt_testbed.killtree(proc.pid)
+    monkeypatch.undo()
+    # the others are killed with the process group
+    assert(killed == left)
+    proc.wait()
+    def state(pid):
+        try:
+            with open('/proc/%i/stat' % pid) as f:
+                return f.read().rsplit(')', 1)[1].split()[0]
+        except OSError:
+            return 'gone'
+    for _ in range(50):
+        if all(state(pid) in ('Z', 'gone') for pid in pids):
+            break
+        time.sleep(0.1)
+    else:
+        assert(False)
+
+def test_execute_interrupted(virtual_server, tmpdir):
+    from reprotest.lib import adt_testbed
+    # the command is not in our process group, so a Ctrl-C that stops
+    # execute() must kill it
+    with reprotest.start_testbed(virtual_server, str(tmpdir)) as testbed:
+        before = set(adt_testbed.descendants(os.getpid()))
+        pids = []
+        def interrupt():
+            pids.extend(set(adt_testbed.descendants(os.getpid())) - before)
+            os.kill(os.getpid(), signal.SIGINT)
+        timer = threading.Timer(0.5, interrupt)
+        timer.start()
+        with pytest.raises(KeyboardInterrupt):
+            testbed.execute(['sleep', '60'])
+        timer.join()
+        assert(pids)
+        def state(pid):
+            try:
+                with open('/proc/%i/stat' % pid) as f:
+                    return f.read().rsplit(')', 1)[1].split()[0]
+            except OSError:
+                return 'gone'
+        for _ in range(50):
+            if all(state(pid) in ('Z', 'gone') for pid in pids):
+                break
+            time.sleep(0.1)
+        else:
+            assert(False)
+
+def test_batch(virtual_server, tmpdir):
+    # "tests" is not a recognised source type, so this only checks the batch
+    # machinery and not the builds themselves
+    store_dir = tmpdir.join('store')
+    retcode = reprotest.check_batch(['tests'], virtual_server, store_dir, jobs=2,
+                                    variations=TEST_VARIATIONS)
+    assert(retcode == 2)
+    assert('unrecognised file type' in store_dir.join('tests.log').read())
+    assert('"status": "error"' in store_dir.join('results.jsonl').read())
+
+def test_batch_worker(tmpdir, monkeypatch):
+    monkeypatch.setattr(reprotest, 'resolve_auto_preset', lambda *args: (
+        'tests', reprotest.presets.ReprotestPreset('true', 'artifact', None, None)))
+    fds = [os.fstat(fd).st_ino for fd in (1, 2)]
+    for exit_arg, code in [((), 0), ((1,), 1), (('failed',), 2)]:
+        def check(*args, **kwargs):
+            raise SystemExit(*exit_arg)
+        monkeypatch.setattr(reprotest, 'check', check)
+        record = reprotest.check_one_of_batch('tests', ['null'], None, str(tmpdir.join('log')))
+        assert(record['retcode'] == code)
+        # our own output doesn't go to the log any more
+        assert([os.fstat(fd).st_ino for fd in (1, 2)] == fds)
+
+def test_sessions(virtual_server, tmpdir):
+    server = reprotest.start_server(virtual_server, str(tmpdir))
+    if 'sessions' not in server.command('capabilities', (), None):
+        server.stop()
+        pytest.skip('%s has no sessions' % virtual_server[0])
+    testbeds = [server.new_session(str(tmpdir)) for _ in range(2)]
+    for testbed in testbeds:
+        testbed.open()
+    scratch = [testbed.scratch for testbed in testbeds]
+    assert(scratch[0] != scratch[1])
+    for testbed in testbeds:
+        testbed.check_exec(['test', '-d', testbed.scratch])
+    # a failure only closes the testbed of its own session
+    with pytest.raises(reprotest.adtlog.TestbedFailure):
+        testbeds[0].command('copyup', ('/nonexistent/', str(tmpdir.join('copy')) + '/'))
+    assert(testbeds[0].scratch is None)
+    testbeds[1].check_exec(['test', '-d', scratch[1]])
+    testbeds[0].open()
+    scratch[0] = testbeds[0].scratch
+    testbeds[0].check_exec(['test', '-d', scratch[0]])
+    testbeds[0].stop()
+    assert(not os.path.exists(scratch[0]))
+    # the other session is still open
+    testbeds[1].check_exec(['test', '-d', scratch[1]])
+    testbeds[1].stop()
+    server.stop()
+    assert(not os.path.exists(scratch[1]))
+
+def test_sessions_concurrent(virtual_server, tmpdir):
+    from reprotest.lib import adt_testbed
+    # a server in a process of its own runs the commands of its sessions at
+    # the same time, and the replies are matched to them by their ids
+    server = adt_testbed.Testbed([reprotest.get_server_path(virtual_server[0])] +
+                                 virtual_server[1:], str(tmpdir), None)
+    server.start()
+    assert(server.server is None)
+    if 'sessions' not in server.command('capabilities', (), None):
+        server.stop()
+        pytest.skip('%s has no sessions' % virtual_server[0])
+    testbeds = [server.new_session(str(tmpdir)) for _ in range(4)]
+    tmpdir.join('src').mkdir().join('f').write('f')
+    failed = []
+    def run(testbed):
+        try:
+            testbed.open()
+            for i in range(5):
+                tb = '%s/%i/' % (testbed.scratch, i)
+                host = tmpdir.join(testbed.session).ensure(dir=True).join(str(i))
+                testbed.command_batch([('copydown', (str(tmpdir.join('src')) + '/', tb), 0),
+                                       ('copyup', (tb, str(host) + '/'), 0)])
+                testbed.command('capabilities', (), None)
+        except Exception as e:
+            failed.append(e)
+    threads = [threading.Thread(target=run, args=(testbed,)) for testbed in testbeds]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert(not failed), failed
+    for testbed in testbeds:
+        for i in range(5):
+            assert(tmpdir.join(testbed.session, str(i), 'f').read() == 'f')
+        testbed.stop()
+    server.stop()
+
+def test_command_batch(virtual_server, tmpdir):
+    server = reprotest.start_server(virtual_server, str(tmpdir))
+    try:
+        if not {'batch', 'sessions'} <= set(server.command('capabilities', (), None)):
+            pytest.skip('%s has no batches or no sessions' % virtual_server[0])
+        # in a session, a failed command doesn't end the server
+        testbed = server.new_session(str(tmpdir))
+        testbed.open()
+        testbed.check_exec(['mkdir', os.path.join(testbed.scratch, 'src')])
+        src = testbed.scratch + '/src/'
+        assert(testbed.command_batch([('copyup', (src, str(tmpdir.join(d)) + '/'), 0)
+                                      for d in ('a', 'b')]) == [[], []])
+        assert(tmpdir.join('a').check(dir=1) and tmpdir.join('b').check(dir=1))
+        # the replies after the failed command are read too
+        with pytest.raises(reprotest.adtlog.TestbedFailure):
+            testbed.command_batch([('copyup', (src, str(tmpdir.join('c')) + '/'), 0),
+                                   ('copyup', ('/nonexistent/', str(tmpdir.join('d')) + '/'), 0),
+                                   ('capabilities', (), None)])
+        assert('batch' in testbed.command('capabilities', (), None))
+        testbed.stop()
+    finally:
+        server.stop()
+
+def test_in_process(virtual_server, tmpdir):
+    if virtual_server != ['null']:
+        pytest.skip('only null always runs in process')
+    testbed = reprotest.open_testbed(virtual_server, str(tmpdir))
+    try:
+        assert(testbed.sp is None and testbed.server is not None)
+        # errors in the server are testbed failures, not exits, and close
+        # the testbed
+        with pytest.raises(reprotest.adtlog.TestbedFailure):
+            testbed.command('no-such-command')
+        assert(testbed.scratch is None)
+        testbed.open()
+        testbed.check_exec(['test', '-d', testbed.scratch])
+        # closing and reopening goes to the server too
+        testbed.check_exec(['touch', os.path.join(testbed.scratch, 'old')])
+        testbed.recycle()
+        assert(not os.path.exists(os.path.join(testbed.scratch, 'old')))
+        # other testbeds get sessions of their own, which don't wait for
+        # this one
+        other = reprotest.open_testbed(virtual_server, str(tmpdir))
+        try:
+            start = time.time()
+            t = threading.Thread(target=other.check_exec, args=(['sleep', '1'],))
+            t.start()
+            testbed.check_exec(['sleep', '1'])
+            t.join()
+            assert(time.time() - start < 1.8)
+        finally:
+            other.stop()
+        # deadlines don't interrupt our main thread
+        from reprotest.lib import VirtSubproc
+        start = time.time()
+        with pytest.raises(VirtSubproc.Timeout):
+            with VirtSubproc.timeout(0.1):
+                time.sleep(0.5)
+        assert(time.time() - start >= 0.5)
+    finally:
+        testbed.stop()
+
+def test_daemon(virtual_server, tmpdir, monkeypatch):
+    monkeypatch.setattr(sys, 'stdout', reprotest.daemon.ThreadOutput(sys.stdout))
+    monkeypatch.setattr(sys, 'stderr', reprotest.daemon.ThreadOutput(sys.stderr))
+    socket_path = str(tmpdir.join('socket'))
+    pool = reprotest.daemon.TestbedPool(virtual_server, 1, str(tmpdir))
+    server = reprotest.daemon.Daemon(socket_path, pool)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        job = {'artifact': 'artifact', 'source_root': os.path.abspath('tests'),
+               'variations': sorted(TEST_VARIATIONS), 'diffoscope_args': None}
+        # the second job runs on the recycled testbed of the first one
+        for command, code in [('python3 mock_build.py; echo built', 0),
+                              ('python3 mock_build.py irreproducible', 1)]:
+            with tmpdir.join('output').open('w') as output:
+                reply = reprotest.daemon.submit(socket_path, dict(job, build_command=command),
+                                                (output.fileno(), output.fileno()))
+            assert(reply['retcode'] == code)
+            if code == 0:
+                # the output of the builds and of the check come back to us
+                assert('built' in tmpdir.join('output').read())
+                assert('Reproduction successful' in tmpdir.join('output').read())
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+        pool.stop()
+
+def test_daemon_exit(monkeypatch):
+    class Pool(object):
+        virtual_server_args = ['null']
+        @reprotest._contextlib.contextmanager
+        def testbed(self):
+            yield None
+    job = {'build_command': 'true', 'artifact': 'artifact'}
+    for exit_arg, code in [((), 0), ((1,), 1), (('failed',), 1)]:
+        def check(*args, **kwargs):
+            raise SystemExit(*exit_arg)
+        monkeypatch.setattr(reprotest, 'check', check)
+        assert(reprotest.daemon.run_job(Pool(), job) == {'retcode': code})
+
+def test_daemon_pool(virtual_server, tmpdir, monkeypatch):
+    pool = reprotest.daemon.TestbedPool(virtual_server, 1, str(tmpdir))
+    try:
+        def fail(*args):
+            raise OSError('failed')
+        with pool.testbed() as testbed:
+            monkeypatch.setattr(testbed, 'recycle', fail)
+            monkeypatch.setattr(pool, 'start', fail)
+        # the testbed could not be replaced, but its slot is not lost
+        assert(pool.testbeds == [])
+        with pytest.raises(reprotest.adtlog.TestbedFailure):
+            with pool.testbed():
+                pass
+        monkeypatch.undo()
+        with pool.testbed() as testbed:
+            testbed.check_exec(['true'])
+        assert(len(pool.testbeds) == 1)
+    finally:
+        pool.stop()
+
 # TODO: test all variations that we support
 @pytest.mark.parametrize('captures', list(reprotest.VARIATIONS.keys()))
 def test_variations(virtual_server, captures):